@@ -1,7 +1,13 @@
 import pygame
 import button
 import csv
+import os
 import pickle
+import sys
+
+# the binary level format lives next to game.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import level_format
 
 pygame.init()
 
@@ -21,7 +27,7 @@ pygame.display.set_caption('Level Editor')
 
 # define game variables
 ROWS = 16
-MAX_COLS = 150
+MAX_COLS = 150  # width of a new level, loaded levels can be wider
 TILE_SIZE = SCREEN_HEIGHT // ROWS
 TILE_TYPES = 21
 level = 3
@@ -91,7 +97,7 @@ def draw_bg():
 
 def draw_grid():
     # vertical lines
-    for c in range(MAX_COLS + 1):
+    for c in range(len(world_data[0]) + 1):
         pygame.draw.line(screen, WHITE, (c * TILE_SIZE - scroll, 0),
                          (c * TILE_SIZE - scroll, SCREEN_HEIGHT))
     # horizontal lines
@@ -149,6 +155,8 @@ while run:
             writer = csv.writer(csvfile, delimiter=',')
             for row in world_data:
                 writer.writerow(row)
+        # binary copy that the game loads without parsing
+        level_format.save(f'level{level}_data.bfl', world_data)
         # alternative pickle method
         #pickle_out = open(f'level{level}_data', 'wb')
         #pickle.dump(world_data, pickle_out)
@@ -157,11 +165,18 @@ while run:
         # load in level data
         # reset scroll back to the start of the level
         scroll = 0
-        with open(f'level{level}_data.csv', newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            for x, row in enumerate(reader):
-                for y, tile in enumerate(row):
-                    world_data[x][y] = int(tile)
+        # start from empty rows, or the tiles of a longer level loaded before would stay past the end
+        for row in world_data:
+            row[:] = [-1] * MAX_COLS
+        if os.path.exists(f'level{level}_data.bfl') and \
+                not level_format.is_stale(f'level{level}_data.bfl', f'level{level}_data.csv'):
+            for x, row in enumerate(level_format.load(f'level{level}_data.bfl')):
+                world_data[x][:len(row)] = row.tolist()
+        else:
+            with open(f'level{level}_data.csv', newline='') as csvfile:
+                reader = csv.reader(csvfile, delimiter=',')
+                for x, row in enumerate(reader):
+                    world_data[x][:len(row)] = [int(tile) for tile in row]
         # alternative pickle method
         #world_data = []
         #pickle_in = open(f'level{level}_data', 'rb')
@@ -183,7 +198,7 @@ while run:
     # scroll the map
     if scroll_left == True and scroll > 0:
         scroll -= 5 * scroll_speed
-    if scroll_right == True and scroll < (MAX_COLS * TILE_SIZE) - SCREEN_WIDTH:
+    if scroll_right == True and scroll < (len(world_data[0]) * TILE_SIZE) - SCREEN_WIDTH:
         scroll += 5 * scroll_speed
 
     # add new tiles to the screen
@@ -0,0 +1,344 @@
+"""
+Benchmarks for the game's hot paths.
+
+Runs the real levels and a set of synthetic stress scenarios headless, times every stage of the
+frame separately and reports per-frame percentiles as JSON. Results can be saved and later compared
+against, so a change that makes a stage slower gets caught before it ships.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json        # exits with 1 if a stage got slower
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from collections import defaultdict
+
+os.environ['BATTLEFIELD_HEADLESS'] = '1'
+import pygame
+import game
+
+SEED = 1234
+# Stages are timed by wrapping these functions, nested stages are also counted in their callers
+# (Soldier.ai includes the enemy's Soldier.move, group update includes Bullet.update and Grenade.update)
+TIMED_METHODS = [
+    ('Soldier.move', game.Soldier, 'move'),
+    ('Soldier.ai', game.Soldier, 'ai'),
+    ('Soldier.navigate', game.Soldier, 'navigate'),
+    ('LineOfSight.can_see', game.LineOfSight, 'can_see'),
+    ('Soldier.draw', game.Soldier, 'draw'),
+    ('EnemyEngine.ai', game.EnemyEngine, 'ai'),
+    ('EnemyEngine.update', game.EnemyEngine, 'update'),
+    ('AiScheduler.update', game.AiScheduler, 'update'),
+    ('ProjectileSystem.update_bullets', game.ProjectileSystem, 'update_bullets'),
+    ('ProjectileSystem.update_grenades', game.ProjectileSystem, 'update_grenades'),
+    ('ProjectileSystem.collide_bullets', game.ProjectileSystem, 'collide_bullets'),
+    ('ProjectileSystem.draw', game.ProjectileSystem, 'draw'),
+    ('Bullet.update', game.Bullet, 'update'),
+    ('Grenade.update', game.Grenade, 'update'),
+    ('World.draw', game.World, 'draw'),
+    ('World.draw_overlay', game.World, 'draw_overlay'),
+    ('group update', pygame.sprite.Group, 'update'),
+    ('group draw', game.Camera, 'draw_group'),
+]
+TIMED_FUNCTIONS = ['draw_bg', 'check_collisions']
+FRAME_STAGES = ['update', 'draw', 'frame']
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = [name for name, owner, attr in TIMED_METHODS] + TIMED_FUNCTIONS + FRAME_STAGES
+        self.reset()
+
+    def reset(self):
+        self.current = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.samples = defaultdict(list)
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.current[name] += time.perf_counter() - start
+                self.calls[name] += 1
+        return timed
+
+    def add(self, name, seconds):
+        self.current[name] += seconds
+        self.calls[name] += 1
+
+    def end_frame(self):
+        # Every stage gets a sample each frame, 0 when it didn't run
+        for name in self.stages:
+            self.samples[name].append(self.current[name])
+        self.current.clear()
+
+    def install(self):
+        for name, owner, attr in TIMED_METHODS:
+            setattr(owner, attr, self.wrap(name, getattr(owner, attr)))
+        for name in TIMED_FUNCTIONS:
+            setattr(game, name, self.wrap(name, getattr(game, name)))
+
+    def summary(self):
+        result = {}
+        for name in self.stages:
+            samples = sorted(self.samples[name])
+            if not samples:
+                continue
+            result[name] = {
+                'calls': self.calls[name],
+                'mean_ms': sum(samples) / len(samples) * 1000,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p90_ms': percentile(samples, 0.90) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        return result
+
+
+def percentile(sorted_samples, q):
+    return sorted_samples[int(round(q * (len(sorted_samples) - 1)))]
+
+
+# ------------------------------------------  SCENARIOS  ------------------------------------------
+def walk_right(frame):
+    # Scripted player: keep running right, jump over things and shoot now and then
+    frame_input = game.INPUT_RIGHT
+    if frame % 45 == 0:
+        frame_input |= game.INPUT_JUMP
+    if frame % 30 < 5:
+        frame_input |= game.INPUT_SHOOT
+    return frame_input
+
+
+def stand_still(frame):
+    return 0
+
+
+def make_invincible():
+    # Stress scenarios measure sustained load, so the player must not die and stop the enemy AI
+    game.player.health = game.player.max_health = 10 ** 9
+
+
+def flat_level(cols):
+    data = [[-1] * cols for row in range(game.ROWS)]
+    for x in range(cols):
+        data[game.ROWS - 1][x] = 0
+    data[game.ROWS - 2][2] = 15  # player
+    return data
+
+
+def generated_level(cols, rng):
+    # Long level with platforms, decorations, pickups and an enemy every few columns
+    data = flat_level(cols)
+    for x in range(8, cols - 4):
+        if rng.random() < 0.08:
+            row = rng.randint(9, 12)
+            for width in range(rng.randint(2, 6)):
+                if x + width < cols:
+                    data[row][x + width] = 4
+        if rng.random() < 0.1:
+            data[game.ROWS - 2][x] = rng.randint(11, 14)
+        elif x % 12 == 0:
+            data[game.ROWS - 2][x] = 16
+        elif rng.random() < 0.02:
+            data[game.ROWS - 2][x] = rng.randint(17, 19)
+    data[game.ROWS - 2][cols - 2] = 20  # exit
+    return data
+
+
+def spawn_enemies(count, cols=game.PAGE_CHUNKS * game.CHUNK_COLS):
+    # Spread over the chunks around the screen, enemies any further away would just get parked
+    for i in range(count):
+        x = (4 + i * (cols - 8) / count) * game.TILE_SIZE
+        game.enemy_group.add(game.Soldier('enemy', x, (game.ROWS - 2) * game.TILE_SIZE, 1.65, 2, 20, 0))
+
+
+def setup_level(level):
+    def setup():
+        game.load_level(level)
+    return setup
+
+
+def setup_enemies(count, spread=game.PAGE_CHUNKS * game.CHUNK_COLS):
+    def setup():
+        cols = 150
+        game.build_world(flat_level(cols))
+        spawn_enemies(count, spread)
+        make_invincible()
+    return setup
+
+
+def setup_wide(cols):
+    def setup():
+        game.build_world(generated_level(cols, random.Random(SEED)))
+        make_invincible()
+    return setup
+
+
+def setup_flat_with_enemies():
+    game.build_world(flat_level(150))
+    spawn_enemies(100)
+    make_invincible()
+
+
+def bullet_storm(rng):
+    # Bullets flying both ways across the screen all the time
+    def per_frame(frame):
+        for i in range(10):
+            x = game.camera.x + rng.randint(0, game.SCREEN_WIDTH)
+            y = rng.randint(game.TILE_SIZE * 8, game.SCREEN_HEIGHT - game.TILE_SIZE * 2)
+            game.fire_bullet(x, y, rng.choice((-1, 1)))
+    return per_frame
+
+
+def grenade_barrage(rng):
+    # Waves of grenades that all go off within a few frames of each other
+    def per_frame(frame):
+        if frame % 100 == 0:
+            for i in range(40):
+                x = game.camera.x + rng.randint(0, game.SCREEN_WIDTH)
+                game.throw_grenade(x, game.TILE_SIZE * 6, rng.choice((-1, 1)))
+    return per_frame
+
+
+SCENARIOS = {
+    'level1': (setup_level(1), walk_right, None),
+    'level2': (setup_level(2), walk_right, None),
+    'level3': (setup_level(3), walk_right, None),
+    'enemies_50': (setup_enemies(50), stand_still, None),
+    'enemies_200': (setup_enemies(200), stand_still, None),
+    'enemies_1000': (setup_enemies(1000), stand_still, None),
+    # Out to the last active chunk, most of them too far away to be seen
+    'enemies_1000_spread': (setup_enemies(1000, (game.PAGE_CHUNKS + 1) * game.CHUNK_COLS), stand_still, None),
+    'bullet_storm': (setup_flat_with_enemies, stand_still, bullet_storm),
+    'grenade_barrage': (setup_flat_with_enemies, stand_still, grenade_barrage),
+    'wide_1000_cols': (setup_wide(1000), walk_right, None),
+}
+
+
+def run_scenario(timer, name, frames):
+    setup, controller, make_per_frame = SCENARIOS[name]
+    game.seed_game(SEED)
+    game.reset_level()
+    setup()
+    per_frame = make_per_frame(random.Random(SEED)) if make_per_frame else None
+    timer.reset()
+    for frame in range(frames):
+        if per_frame:
+            per_frame(frame)
+        start = time.perf_counter()
+        game.step_game(controller(frame))
+        middle = time.perf_counter()
+        game.draw_game()
+        end = time.perf_counter()
+        timer.add('update', middle - start)
+        timer.add('draw', end - middle)
+        timer.add('frame', end - start)
+        timer.end_frame()
+    return {
+        'frames': frames,
+        'enemies': len(game.enemy_group),
+        'stages': timer.summary(),
+        # Pools live for the whole process, so their high-water marks include earlier scenarios
+        'pools': {
+            'bullet': game.bullet_pool.stats(),
+            'grenade': game.grenade_pool.stats(),
+            'explosion': game.explosion_pool.stats(),
+        },
+    }
+
+
+def compare(results, baseline, threshold, min_ms):
+    # A stage regressed when its median got more than threshold times slower than in the baseline.
+    # Stages faster than min_ms in both runs are too noisy to compare.
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        base_scenario = baseline.get('scenarios', {}).get(name)
+        if base_scenario is None:
+            continue
+        for stage, timing in scenario['stages'].items():
+            base_timing = base_scenario['stages'].get(stage)
+            if base_timing is None or max(timing['p50_ms'], base_timing['p50_ms']) < min_ms:
+                continue
+            ratio = timing['p50_ms'] / base_timing['p50_ms'] if base_timing['p50_ms'] else float('inf')
+            if ratio > threshold:
+                regressions.append({'scenario': name, 'stage': stage, 'baseline_p50_ms': base_timing['p50_ms'],
+                                    'p50_ms': timing['p50_ms'], 'ratio': ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of the game loop on real and stress levels.')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run (default: all of {", ".join(SCENARIOS)})')
+    parser.add_argument('--frames', type=int, default=600, help='frames to run per scenario')
+    parser.add_argument('--output', metavar='FILE', help='write the results to FILE instead of stdout')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    parser.add_argument('--min-ms', type=float, default=0.05, help='ignore stages faster than this when comparing')
+    parser.add_argument('--enemy-engine', choices=['sprites', 'numpy'], default='sprites', help='how the enemies are updated')
+    parser.add_argument('--ai-budget', type=int, metavar='N', help='let at most N enemies think per frame (default: all of them)')
+    parser.add_argument('--enemy-ai', choices=['patrol', 'navigate'], default='patrol', help='how the enemies decide where to go')
+    parser.add_argument('--enemy-vision', choices=['rect', 'raycast'], default='rect', help='how the enemies look for the player')
+    parser.add_argument('--vision-range', type=int, default=150, help='raycast vision: how many pixels far the enemies see')
+    parser.add_argument('--vision-cone', type=float, default=30, help='raycast vision: how many degrees above or below straight ahead the enemies see')
+    parser.add_argument('--projectiles', choices=['sprites', 'numpy'], default='sprites', help='how bullets and grenades are updated')
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name!r}')
+
+    try:
+        game.apply_settings({'enemy_engine': args.enemy_engine, 'ai_budget': args.ai_budget, 'enemy_ai': args.enemy_ai,
+                             'enemy_vision': args.enemy_vision, 'vision_range': args.vision_range, 'vision_cone': args.vision_cone,
+                             'projectiles': args.projectiles})
+    except ValueError as error:
+        parser.error(str(error))
+
+    timer = StageTimer()
+    timer.install()
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'platform': platform.platform(),
+            'frames': args.frames,
+            'seed': SEED,
+            **game.simulation_settings(),
+        },
+        'scenarios': {},
+    }
+    for name in names:
+        results['scenarios'][name] = run_scenario(timer, name, args.frames)
+        frame = results['scenarios'][name]['stages']['frame']
+        print(f'{name:>16}: frame p50 {frame["p50_ms"]:.3f} ms, p99 {frame["p99_ms"]:.3f} ms', file=sys.stderr)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['regressions'] = compare(results, baseline, args.threshold, args.min_ms)
+        for regression in results['regressions']:
+            print(f'REGRESSION {regression["scenario"]} / {regression["stage"]}: '
+                  f'{regression["baseline_p50_ms"]:.3f} ms -> {regression["p50_ms"]:.3f} ms', file=sys.stderr)
+        if results['regressions']:
+            exit_code = 1
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    pygame.quit()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,37 @@
-import pygame
+import argparse
+import csv
+import json
+import math
 import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Headless mode simulates the game without a window, sound or frame cap,
+# set BATTLEFIELD_HEADLESS=1 or run game.py --headless
+HEADLESS = os.environ.get('BATTLEFIELD_HEADLESS') == '1' or \
+    (__name__ == '__main__' and ('--headless' in sys.argv or '--replay' in sys.argv))
+if HEADLESS:
+    # SDL's dummy drivers need no display or sound card
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import pygame
 import random
-import csv
 from pygame import mixer
 
+import level_format
+
+try:
+    import numpy as np  # optional, only needed for --enemy-engine numpy
+except ImportError:
+    np = None
+
 mixer.init()
 pygame.init()
 
@@ -22,12 +50,12 @@ GRAVITY = 0.75
 SCREEN_THRESHOLD = 200  # Not to scroll when the player reaches to the end of the screen
 # When player reaches at 200px left or right, the screen will move
 
-ROWS = 16  # For world co-ordinates
-COLS = 150  # For world co-ordinates
+ROWS = 16  # For world co-ordinates, levels can be any number of columns wide
 TILE_SIZE = SCREEN_HEIGHT // ROWS
 TILE_TYPES = 21
-screen_scroll = 0
-bg_scroll = 0
+CHUNK_COLS = 20  # Levels are loaded, pre-rendered and thrown away in chunks this many columns wide
+PAGE_CHUNKS = 2  # Chunks kept loaded to each side of the screen
+EVICT_CHUNKS = 4  # Chunks further than this from the screen get unloaded
 MAX_LEVELS = 3
 level = 3
 
@@ -35,6 +63,19 @@ start_game = False
 start_intro = False
 
 
+# Input bits for one frame. Left, right, shoot and grenade are held down,
+# jump is set on the frame the key was pressed.
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_SHOOT = 8
+INPUT_GRENADE = 16
+INPUT_RESTART = 32  # restart button clicked on the death screen
+
+# The game owns its random numbers and its clock, so a run can be played back exactly
+rng = random.Random()
+frame_count = 0  # frames simulated since the game was seeded
+
 # Define player action variables
 moving_left = False
 moving_right = False
@@ -44,9 +85,10 @@ grenade_thrown = False
 
 
 # Load music and sound
-pygame.mixer.music.load('audio/music2.mp3')
-pygame.mixer.music.set_volume(0.3)
-pygame.mixer.music.play(-1, 0.0, 5000)
+if not HEADLESS:
+    pygame.mixer.music.load('audio/music2.mp3')
+    pygame.mixer.music.set_volume(0.3)
+    pygame.mixer.music.play(-1, 0.0, 5000)
 
 jump_fx = pygame.mixer.Sound('audio/jump.wav')
 jump_fx.set_volume(0.5)
@@ -56,6 +98,11 @@ grenade_fx = pygame.mixer.Sound('audio/grenade.wav')
 grenade_fx.set_volume(0.5)
 
 
+def play_fx(fx):
+    if not HEADLESS:
+        fx.play()
+
+
 # Load images
 # Background Images
 pine1_img = pygame.image.load('img/background/pine1.png').convert_alpha()
@@ -100,37 +147,183 @@ PINK = (235, 65, 54)
 
 # Define font
 font = pygame.font.SysFont('Futura', 30)
-def draw_text(text, font, text_col, x, y):
-    img = font.render(text, True, text_col)
-    screen.blit(img, (x, y))
+def seed_game(seed):
+    global frame_count
+    rng.seed(seed)
+    frame_count = 0
+
+
+def game_ticks():
+    # Milliseconds of game time, counted in simulated frames instead of read from the wall clock
+    return frame_count * 1000 // FPS
+
+
+@lru_cache(maxsize=256)
+def render_text(text, font, text_col):
+    # The same few strings get drawn over and over, so each one is only rendered once
+    return font.render(text, True, text_col)
+
+
+def draw_text(text, font, text_col, x, y, surface=None):
+    (surface or screen).blit(render_text(text, font, text_col), (x, y))
+
+class ParallaxBackground:
+    # The scrolling background, prepared once from the layer images so that each frame only copies
+    # what can actually be seen. Layers are given back to front as (image, scroll speed, y).
+    # Rows hidden behind the solid bottom of a nearer layer are cut off, the farthest layer gets the
+    # background colour filled in underneath it, so the screen never has to be filled first, and every
+    # layer is split into its solid rows, copied without blending, and the rows above them, which keep
+    # their transparency but are run-length encoded so the see-through parts are skipped quickly.
+    def __init__(self, layers, fill):
+        self.strips = []  # (surface, scroll speed, y), back to front
+        cover = SCREEN_HEIGHT  # everything from this row down is hidden by a nearer layer
+        for index in reversed(range(len(layers))):
+            image, speed, y = layers[index]
+            width = image.get_width()
+            if index == 0:
+                far = pygame.Surface((width, cover))
+                far.fill(fill)
+                far.blit(image, (0, y))
+                self.strips.insert(0, (far.convert(), speed, 0))
+                break
+            height = min(image.get_height(), cover - y)
+            if height <= 0:
+                continue
+            solid = self.solid_from(image, height)
+            strips = []
+            if solid > 0:
+                top = image.subsurface(0, 0, width, solid).copy()
+                top.set_alpha(255, pygame.RLEACCEL)
+                strips.append((top, speed, y))
+            if solid < height:
+                strips.append((image.subsurface(0, solid, width, height - solid).convert(), speed, y + solid))
+                cover = y + solid
+            self.strips[0:0] = strips
+
+    @staticmethod
+    def solid_from(image, height):
+        # First row from which every row down to height is fully opaque
+        mask = pygame.mask.from_surface(image, 254)
+        row = pygame.mask.Mask((image.get_width(), 1), fill=True)
+        solid = height
+        while solid > 0 and mask.overlap_area(row, (0, solid - 1)) == image.get_width():
+            solid -= 1
+        return solid
+
+    def draw(self, surface, scroll):
+        # Each strip repeats across the level, one or two copies of it cover the screen
+        for image, speed, y in self.strips:
+            width = image.get_width()
+            x = -(int(scroll * speed) % width)
+            while x < SCREEN_WIDTH:
+                surface.blit(image, (x, y))
+                x += width
+
+
+background = ParallaxBackground([
+    (sky_img, 0.5, 0),
+    (mountain_img, 0.6, SCREEN_HEIGHT - mountain_img.get_height() - 300),
+    (pine1_img, 0.7, SCREEN_HEIGHT - pine1_img.get_height() - 150),
+    (pine2_img, 0.8, SCREEN_HEIGHT - pine2_img.get_height()),
+], BG)
+
 
 def draw_bg():
-    screen.fill(BG)
-    width = sky_img.get_width()
-    for x in range(5):
-        screen.blit(sky_img, ((x * width) - bg_scroll * 0.5, 0))
-        screen.blit(mountain_img, ((x * width) - bg_scroll * 0.6, SCREEN_HEIGHT - mountain_img.get_height() - 300))
-        screen.blit(pine1_img, ((x * width) - bg_scroll * 0.7, SCREEN_HEIGHT - pine1_img.get_height() - 150))
-        screen.blit(pine2_img, ((x * width) - bg_scroll * 0.8, SCREEN_HEIGHT - pine2_img.get_height()))
+    background.draw(screen, camera.x)
+
+
+class Camera:
+    # Everything in the level keeps its world position, the camera offset is only applied when blitting
+    def __init__(self):
+        self.x = 0  # world x-coordinate of the left edge of the screen
+
+    def reset(self):
+        self.x = 0
+
+    def scroll(self, dx):
+        self.x += dx
+
+    def can_see(self, rect):
+        return rect.right > self.x and rect.left < self.x + SCREEN_WIDTH
+
+    def blit(self, surface, image, rect):
+        surface.blit(image, (rect.x - self.x, rect.y))
+
+    def draw_group(self, surface, group):
+        # Same as group.draw(surface), but offset by the camera and skipping sprites off screen
+        surface.blits([(sprite.image, (sprite.rect.x - self.x, sprite.rect.y))
+                       for sprite in group if self.can_see(sprite.rect)], False)
+
+
+camera = Camera()
 
 # Function to reset the level
 def reset_level():
     enemy_group.empty()  # will delete all the instances of the group
-    bullet_group.empty()
-    grenade_group.empty()
-    explosion_group.empty()
+    # Pooled sprites have to be killed so they go back to their pools
+    bullet_pool.release_all(bullet_group)
+    grenade_pool.release_all(grenade_group)
+    explosion_pool.release_all(explosion_group)
+    if projectile_system is not None:
+        projectile_system.clear()
     item_box_group.empty()
     decoration_group.empty()
     water_group.empty()
     exit_group.empty()
+    dynamic_hash.clear()  # the sprites of the old world mustn't be found in the new one
+
 
-    # Create empty tile list
-    data = []
-    for row in range(ROWS):
-        r = [-1] * COLS
-        data.append(r)
-    return data
+class AnimationCache:
+    # Process-wide store of scaled animation frames, keyed by (char_type, animation, scale).
+    # Each frame set is loaded from disk once and every soldier of that kind shares the same surfaces.
+    # The mirrored frames for facing left are made at the same time, so drawing never has to flip.
+    # The level loader's thread makes soldiers too, so the cache is only used while holding its lock.
+    def __init__(self):
+        self.frames = {}
+        self.flipped_frames = {}
+        self.loads = 0  # frame sets loaded from disk
+        self.hits = 0  # frame sets served from memory
+        self.lock = threading.Lock()
+
+    def get(self, char_type, animation, scale):
+        key = (char_type, animation, scale)
+        with self.lock:
+            if key in self.frames:
+                self.hits += 1
+                return self.frames[key], self.flipped_frames[key]
+            self.loads += 1
+            temp_list = []
+            # Count number of files within a folder
+            num_of_frames = len(os.listdir(f'img/{char_type}/{animation}'))
+            for i in range(num_of_frames):
+                img = pygame.image.load(f'img/{char_type}/{animation}/{i}.png').convert_alpha()
+                img = pygame.transform.scale(img, (int(img.get_width() * scale), int(img.get_height() * scale)))
+                temp_list.append(img)
+            self.frames[key] = temp_list
+            self.flipped_frames[key] = [pygame.transform.flip(img, True, False) for img in temp_list]
+            return self.frames[key], self.flipped_frames[key]
+
+    def get_explosion(self, scale):
+        key = ('explosion', 'exp', scale)
+        with self.lock:
+            if key in self.frames:
+                self.hits += 1
+                return self.frames[key]
+            self.loads += 1
+            temp_list = []
+            for num in range(1, 6):
+                img = pygame.image.load(f'img/explosion/exp{num}.png').convert_alpha()
+                img = pygame.transform.scale(img, (int(img.get_width() * scale), int(img.get_height() * scale)))
+                temp_list.append(img)
+            self.frames[key] = temp_list
+            return temp_list
 
+    def stats(self):
+        with self.lock:
+            return {'frame_sets': len(self.frames), 'loads': self.loads, 'hits': self.hits}
+
+
+animation_cache = AnimationCache()
 
 
 class Soldier(pygame.sprite.Sprite):
@@ -145,37 +338,37 @@ class Soldier(pygame.sprite.Sprite):
         self.grenades = grenades
         self.health = 100
         self.max_health = self.health
+        self.last_damage = None  # what hurt the soldier last: 'bullet', 'grenade', 'water' or 'fall'
+        self.pickups = dict.fromkeys(item_boxes, 0)  # item boxes picked up, by type
         self.direction = 1
         self.vel_y = 0
         self.jump = False
         self.in_air = True  # Player is in air until he lands on to something
         self.flip = False
         self.animation_list = []
+        self.flipped_animation_list = []  # same frames mirrored, for when the soldier faces left
         self.frame_index = 0
         self.action = 0  # Idle
-        self.update_time = pygame.time.get_ticks()  # track the time
+        self.update_time = game_ticks()  # track the time
 
         # Create ai specific variables
         self.move_counter = 0
         self.vision = pygame.Rect(0, 0, 150, 20)  # 150 -> width -> x-direction -> how far enemy can look
         self.idling = False
         self.idling_counter = 0
+        self.nav_goal = None  # span the enemy last saw the player on, with --enemy-ai navigate
+        self.nav_link = None  # link it is jumping or dropping along
         
 
-        # Load all images for the players
+        # Get all images for the players, shared with every other soldier of the same type
         animation_types = ['Idle', 'Run', 'Jump', 'Death']
         for animation in animation_types:
-            #  Reset temporary list of images
-            temp_list = []
-            # Count number of files within a folder
-            num_of_frames = len(os.listdir(f'img/{self.char_type}/{animation}'))
-            for i in range(num_of_frames):
-                img = pygame.image.load(f'img/{self.char_type}/{animation}/{i}.png').convert_alpha()
-                img = pygame.transform.scale(img, (int(img.get_width() * scale), int(img.get_height() * scale)))
-                temp_list.append(img)
-            self.animation_list.append(temp_list)  # list of lists
+            frames, flipped_frames = animation_cache.get(self.char_type, animation, scale)
+            self.animation_list.append(frames)  # list of lists
+            self.flipped_animation_list.append(flipped_frames)
 
         self.image = self.animation_list[self.action][self.frame_index]
+        self.flipped_image = self.flipped_animation_list[self.action][self.frame_index]
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
         self.width = self.image.get_width()
@@ -190,7 +383,7 @@ class Soldier(pygame.sprite.Sprite):
 
     def move(self, moving_left, moving_right):
 
-        screen_scroll = 0
+        scroll = 0
         # Reset movement variables - change in x and change in y
         dx = 0
         dy = 0
@@ -217,7 +410,10 @@ class Soldier(pygame.sprite.Sprite):
         dy += self.vel_y
 
         # Check for collision
-        for tile in world.obstacle_list:
+        # Only the tiles in the grid cells around the soldier can be hit, so look those up
+        # instead of walking the whole world.obstacle_list
+        search_rect = self.rect.union(self.rect.move(dx, dy))
+        for tile in world.query('obstacle', search_rect):
             # Check for collision in x-direction
             if tile[1].colliderect(self.rect.x + dx, self.rect.y, self.width, self.height):
                 # tile[1] means the rect of that particular tile
@@ -240,21 +436,23 @@ class Soldier(pygame.sprite.Sprite):
 
 
         # Check for collision with water
-        if pygame.sprite.spritecollide(self, water_group, False):
-            self.health = 0
+        for water in world.query('water', self.rect):
+            if water.rect.colliderect(self.rect):
+                self.hurt(self.health, 'water')
         
         # Check for collision with exit
         level_complete = False
-        if pygame.sprite.spritecollide(self, exit_group, False):
-            level_complete = True
+        for exit1 in world.query('exit', self.rect):
+            if exit1.rect.colliderect(self.rect):
+                level_complete = True
 
         # Check if fallen off the map
         if self.rect.bottom > SCREEN_HEIGHT:
-            self.health = 0
+            self.hurt(self.health, 'fall')
 
         # Check if going of the edge of the screen
         if self.char_type == 'player':
-            if self.rect.left + dx < 0 or self.rect.right + dx > SCREEN_WIDTH:
+            if self.rect.left + dx < camera.x or self.rect.right + dx > camera.x + SCREEN_WIDTH:
                 dx = 0
 
         # Update rectangle position
@@ -263,35 +461,38 @@ class Soldier(pygame.sprite.Sprite):
 
         # Update scroll based on player position
         if self.char_type == 'player':
-            if (self.rect.right > SCREEN_WIDTH - SCREEN_THRESHOLD and bg_scroll < (world.level_length * TILE_SIZE) - SCREEN_WIDTH) or (self.rect.left < SCREEN_THRESHOLD and bg_scroll > abs(dx)):
-                self.rect.x -= dx
-                screen_scroll = -dx
-        return screen_scroll, level_complete
+            screen_left = self.rect.left - camera.x
+            screen_right = self.rect.right - camera.x
+            if (screen_right > SCREEN_WIDTH - SCREEN_THRESHOLD and camera.x < (world.level_length * TILE_SIZE) - SCREEN_WIDTH) or (screen_left < SCREEN_THRESHOLD and camera.x > abs(dx)):
+                # The camera follows the player, so the player stays at the same place on screen
+                scroll = dx
+        return scroll, level_complete
     
     def shoot(self):
         if self.shoot_cooldown == 0 and self.ammo > 0:
             self.shoot_cooldown = 20
-            bullet = Bullet(self.rect.centerx + (0.75 * self.rect.size[0] * self.direction), self.rect.centery, self.direction)
-            bullet_group.add(bullet)
+            fire_bullet(self.rect.centerx + (0.75 * self.rect.size[0] * self.direction), self.rect.centery, self.direction)
             # Reduce ammo
             self.ammo -= 1
-            shot_fx.play()
+            play_fx(shot_fx)
     
     def ai(self):
         if self.alive and player.alive:
-            if self.idling == False and random.randint(1, 200) == 1:
+            if self.idling == False and rng.randint(1, 200) == 1:
                 self.update_action(0)  # Idle animation : 0
                 self.idling = True
                 self.idling_counter = 50
             
             # Check if the AI is near the player
-            if self.vision.colliderect(player.rect):
+            if self.sees(player):
                 # Stop Running and face the player
                 self.update_action(0)  # Idle state
                 self.shoot()  # Shoot
 
             else:
                 if self.idling  == False:
+                    if navigate_enemies:
+                        self.navigate()
                     if self.direction == 1:
                         ai_moving_rigth = True
                     else:
@@ -304,7 +505,7 @@ class Soldier(pygame.sprite.Sprite):
                     self.vision.center = (self.rect.centerx + 75 * self.direction, self.rect.centery)
                     # pygame.draw.rect(screen, RED, self.vision)
 
-                    if self.move_counter > TILE_SIZE:
+                    if self.move_counter > TILE_SIZE and not navigate_enemies:
                         self.direction *= -1
                         self.move_counter *= -1
                 else:
@@ -312,8 +513,51 @@ class Soldier(pygame.sprite.Sprite):
                     if self.idling_counter <= 0:
                         self.idling = False
 
-        # Scroll
-        self.rect.x += screen_scroll
+    def sees(self, target):
+        if line_of_sight is not None:
+            return line_of_sight.can_see(self, target)
+        return self.vision.colliderect(target.rect)
+
+    def navigate(self):
+        # Choose which way to go from the level's NavGraph instead of finding out by walking into things:
+        # head for the player when it is close enough and there is a way to it, otherwise patrol
+        # without walking off the span the enemy stands on
+        CHASE_DISTANCE = SCREEN_WIDTH // 2
+        nav = world.nav
+        span = nav.span_at(self.rect)
+        if span is None:
+            # In the air. Bumping into a wall turns an enemy around, but the link was found going
+            # the same way all along.
+            if self.nav_link is not None:
+                self.direction = self.nav_link[0]
+            return
+        self.nav_link = None
+        if abs(player.rect.centerx - self.rect.centerx) < CHASE_DISTANCE:
+            # While the player is in the air it is chased to where it was last seen standing
+            player_span = nav.span_at(player.rect)
+            if player_span is not None:
+                self.nav_goal = player_span
+        else:
+            self.nav_goal = None
+        if self.nav_goal == span:
+            self.direction = 1 if player.rect.centerx > self.rect.centerx else -1
+            return
+        link = nav.next_link(span, self.nav_goal) if self.nav_goal is not None else None
+        if link is not None:
+            direction, kind, start_x, landing = link
+            self.direction = direction
+            self.nav_link = link
+            # Jump from where the graph found the jump works, drops just walk off the end
+            if kind == 'jump' and (self.rect.x + direction * self.speed - start_x) * direction >= 0:
+                self.jump = True
+            return
+        if self.move_counter > TILE_SIZE:
+            self.direction *= -1
+            self.move_counter *= -1
+        # Turn before stepping onto a cell that can't be stood on
+        ahead = (self.rect.right - 1 + self.speed) // TILE_SIZE if self.direction == 1 else (self.rect.left - self.speed) // TILE_SIZE
+        if not nav.standable(ahead, span[0]):
+            self.direction *= -1
 
     def update_animation(self):
         # Update animation
@@ -321,11 +565,12 @@ class Soldier(pygame.sprite.Sprite):
 
         # Update image depending on current frame
         self.image = self.animation_list[self.action][self.frame_index]
+        self.flipped_image = self.flipped_animation_list[self.action][self.frame_index]
 
         # Check if enough time has passed since the last update
-        if pygame.time.get_ticks() - self.update_time > ANIMATION_COOLDOWN:
+        if game_ticks() - self.update_time > ANIMATION_COOLDOWN:
             # Go to the next frame on the animation, i.e next image from the list
-            self.update_time = pygame.time.get_ticks()  # resets the timer
+            self.update_time = game_ticks()  # resets the timer
             self.frame_index += 1
 
         # if image list has fully traversed, reset it back to start
@@ -344,7 +589,12 @@ class Soldier(pygame.sprite.Sprite):
 
             # update animation settings
             self.frame_index = 0
-            self.update_time = pygame.time.get_ticks() 
+            self.update_time = game_ticks()
+
+    def hurt(self, damage, cause):
+        self.health -= damage
+        if self.alive:
+            self.last_damage = cause  # kept once dead, so it tells what killed the soldier
 
     def check_alive(self):
         if self.health <= 0:
@@ -356,20 +606,437 @@ class Soldier(pygame.sprite.Sprite):
 
 
     def draw(self):
-        screen.blit(pygame.transform.flip(self.image, self.flip, False), self.rect)
+        # Pick the pre-flipped frame instead of flipping the image every frame
+        camera.blit(screen, self.flipped_image if self.flip else self.image, self.rect)
         # pygame.draw.rect(screen, RED, self.rect, 1)  # rects on screen
 
 
-class World:
+class AiScheduler:
+    # Level of detail for the enemies (--ai-budget), so the cost of their thinking depends on
+    # the budget rather than on how many of them the loaded chunks hold:
+    # - near: on screen or a few tiles off it, think and animate every frame
+    # - distant: further out, take turns with whatever is left of the budget, so each one gets
+    #   an ai() and update() every few frames and patrols at a slower pace while nobody sees it
+    # - dormant: beyond that, or parked in a chunk that isn't active, nothing runs until the
+    #   player gets closer
+    # Corpses drop out once their death animation has played, they are only drawn from then on.
+    # The budget counts enemies rather than milliseconds, so replays stay deterministic.
+    NEAR_DISTANCE = TILE_SIZE * 8  # pixels off screen
+    DISTANT_DISTANCE = CHUNK_COLS * TILE_SIZE * PAGE_CHUNKS
+
+    def __init__(self, budget):
+        self.budget = budget  # most enemies thinking per frame, near ones always do
+        self.turn = 0  # where the distant enemies' round robin carries on next frame
+        self.tiers = {'near': 0, 'distant': 0, 'dormant': 0, 'corpses': 0}  # counts of the last frame
+
+    def is_corpse(self, enemy):
+        return not enemy.alive and enemy.action == 3 and enemy.frame_index == len(enemy.animation_list[3]) - 1
+
+    def distance(self, enemy):
+        # How far the enemy is outside the screen, 0 when it's on it
+        return max(camera.x - enemy.rect.right, enemy.rect.left - (camera.x + SCREEN_WIDTH), 0)
+
+    def update(self, enemies):
+        near = []
+        distant = []
+        corpses = 0
+        for enemy in enemies:
+            if self.is_corpse(enemy):
+                corpses += 1
+                continue
+            distance = self.distance(enemy)
+            if distance <= self.NEAR_DISTANCE:
+                near.append(enemy)
+            elif distance <= self.DISTANT_DISTANCE:
+                distant.append(enemy)
+        # At least one distant enemy gets a turn, so they never stop completely
+        slots = min(max(self.budget - len(near), 1), len(distant))
+        thinking = near + [distant[(self.turn + i) % len(distant)] for i in range(slots)]
+        self.turn = (self.turn + slots) % len(distant) if distant else 0
+        for enemy in thinking:
+            enemy.ai()
+            enemy.update()
+        self.tiers = {'near': len(near), 'distant': len(distant),
+                      'dormant': len(enemies) - corpses - len(near) - len(distant) + len(world.parked), 'corpses': corpses}
+
+
+class LineOfSight:
+    # Enemy vision that walls block (--enemy-vision raycast), instead of the vision rect that sees
+    # through them. An enemy sees the player when the player is within view_range pixels of its
+    # eyes, no more than cone degrees off the way it faces, and a ray between them crosses no
+    # obstacle tile. Rays are walked cell by cell through the level data (DDA) from the centre of
+    # the enemy's eye cell to the centre of the player's cell, so the answer only changes when one
+    # of them moves to another cell: it is kept per pair of cells and a ray is only cast again
+    # for a pair that hasn't been seen yet. The range and cone tests come first, so most enemies
+    # never get as far as the ray.
+    EYE_HEIGHT = 15  # pixels below the top of the enemy's rect
+    MAX_CACHED = 1 << 16  # pairs of cells kept before the cache starts over
+
+    def __init__(self, view_range, cone):
+        self.view_range = view_range
+        self.cone = cone
+        self.cos_cone = math.cos(math.radians(cone))
+        self.level_data = None  # the cache belongs to this level
+        self.clear = {}  # (eye cell, target cell) -> True when no obstacle is in the way
+        self.counts = {'rays': 0, 'cached': 0}  # of the last frame, for the profiler overlay
+        self.rays = 0
+        self.cached = 0
+
+    def new_frame(self):
+        self.counts = {'rays': self.rays, 'cached': self.cached}
+        self.rays = 0
+        self.cached = 0
+
+    def can_see(self, enemy, target):
+        eye_x = enemy.rect.centerx
+        eye_y = enemy.rect.top + self.EYE_HEIGHT
+        dx = target.rect.centerx - eye_x
+        dy = target.rect.centery - eye_y
+        distance_squared = dx * dx + dy * dy
+        if distance_squared > self.view_range * self.view_range:
+            return False
+        if dx * enemy.direction < self.cos_cone * math.sqrt(distance_squared):
+            return False
+        if world.level_data is not self.level_data or len(self.clear) >= self.MAX_CACHED:
+            self.level_data = world.level_data
+            self.clear = {}
+        key = (eye_x // TILE_SIZE, eye_y // TILE_SIZE, target.rect.centerx // TILE_SIZE, target.rect.centery // TILE_SIZE)
+        clear = self.clear.get(key)
+        if clear is None:
+            clear = self.clear[key] = self.cast(*key)
+            self.rays += 1
+        else:
+            self.cached += 1
+        return clear
+
+    def solid(self, col, row):
+        if 0 <= row < world.rows and 0 <= col < world.level_length:
+            return 0 <= world.level_data[row][col] <= 8
+        return False
+
+    def cast(self, col, row, end_col, end_row):
+        # Walk the cells the line between the two cell centres crosses, in whole numbers: the line
+        # meets the next column edge at (2 * i + 1) / (2 * cols) of the way and the next row edge at
+        # (2 * j + 1) / (2 * rows), so comparing (2 * i + 1) * rows with (2 * j + 1) * cols says
+        # which comes first. Through a corner the cells on both sides have to be free.
+        cols = abs(end_col - col)
+        rows = abs(end_row - row)
+        step_col = 1 if end_col > col else -1
+        step_row = 1 if end_row > row else -1
+        i = j = 0
+        while i < cols or j < rows:
+            next_col = (2 * i + 1) * rows if i < cols else None
+            next_row = (2 * j + 1) * cols if j < rows else None
+            if next_row is None or next_col is not None and next_col < next_row:
+                col += step_col
+                i += 1
+            elif next_col is None or next_row < next_col:
+                row += step_row
+                j += 1
+            else:
+                if self.solid(col + step_col, row) or self.solid(col, row + step_row):
+                    return False
+                col += step_col
+                row += step_row
+                i += 1
+                j += 1
+            if self.solid(col, row):
+                return False
+        return True
+
+
+class TileGrids:
+    # NumPy obstacle and water grids over the loaded chunks of the world, for the batched
+    # enemy and projectile engines. Cells of chunks that aren't loaded are empty.
     def __init__(self):
+        self.obstacle_list = world.obstacle_list  # changes whenever chunks are loaded or unloaded
+        first_chunk, last_chunk = min(world.chunks), max(world.chunks)
+        self.first_col = first_chunk * CHUNK_COLS
+        last_col = min((last_chunk + 1) * CHUNK_COLS, world.level_length)
+        tiles = np.array([np.asarray(row[self.first_col:last_col]) for row in world.level_data], dtype=np.int8)
+        for index in range(first_chunk, last_chunk + 1):
+            if index not in world.chunks:
+                tiles[:, index * CHUNK_COLS - self.first_col:(index + 1) * CHUNK_COLS - self.first_col] = -1
+        # A border of empty cells all round, so looking up any cell outside is just clamping onto it
+        tiles = np.pad(tiles, 1, constant_values=-1)
+        self.obstacle = (tiles >= 0) & (tiles <= 8)
+        self.water = (tiles >= 9) & (tiles <= 10)
+
+    def cells(self, grid, row, col):
+        # grid[row, col] for arrays of cells, False outside the loaded part of the level
+        row = np.minimum(np.maximum(row + 1, 0), grid.shape[0] - 1)
+        col = np.minimum(np.maximum(col - self.first_col + 1, 0), grid.shape[1] - 1)
+        return grid[row, col]
+
+    def overlaps(self, grid, x, y, width, height):
+        # True for every rect that overlaps a set cell of grid, like colliderect against each tile's rect
+        hit = np.zeros(len(x), dtype=bool)
+        first_row, last_row = y // TILE_SIZE, (y + height - 1) // TILE_SIZE
+        first_col, last_col = x // TILE_SIZE, (x + width - 1) // TILE_SIZE
+        for row_offset in range(int((last_row - first_row).max(initial=0)) + 1):
+            for col_offset in range(int((last_col - first_col).max(initial=0)) + 1):
+                row, col = first_row + row_offset, first_col + col_offset
+                hit |= (row <= last_row) & (col <= last_col) & self.cells(grid, row, col)
+        return hit
+
+
+tile_grids_cache = None
+
+
+def rect_round(values):
+    # What a Rect does with a float position: round to the nearest pixel, halves away from zero
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+
+def tile_grids():
+    # The TileGrids of the loaded chunks, made again after the world pages chunks in or out
+    global tile_grids_cache
+    if tile_grids_cache is None or tile_grids_cache.obstacle_list is not world.obstacle_list:
+        tile_grids_cache = TileGrids()
+    return tile_grids_cache
+
+
+class EnemyEngine:
+    # Runs every enemy's AI, movement and animation at once, on NumPy arrays with one entry per
+    # enemy (struct of arrays) instead of a Soldier.ai() and Soldier.update() call each.
+    # It follows the same rules as Soldier.ai, Soldier.move and Soldier.update. The Soldier sprites
+    # are still drawn, shot and blown up as usual, their state is copied back every frame.
+    ANIMATION_COOLDOWN = 100  # same as in Soldier.update_animation
+
+    def __init__(self):
+        self.sprites = []
+        self.grids = None
+        self.random = None
+
+    def load(self, sprites):
+        # Write the state of the old enemies back to their sprites, then copy in the new ones
+        self.flush()
+        self.sprites = sprites
+        self.random = np.random.default_rng(rng.getrandbits(64))  # seeded from the game's rng, so runs stay deterministic
+        self.x = np.array([sprite.rect.x for sprite in sprites], dtype=np.int64)
+        self.y = np.array([sprite.rect.y for sprite in sprites], dtype=np.int64)
+        self.width = np.array([sprite.width for sprite in sprites], dtype=np.int64)
+        self.height = np.array([sprite.height for sprite in sprites], dtype=np.int64)
+        self.vel_y = np.array([sprite.vel_y for sprite in sprites], dtype=np.float64)
+        self.speed = np.array([sprite.speed for sprite in sprites], dtype=np.int64)
+        self.direction = np.array([sprite.direction for sprite in sprites], dtype=np.int64)
+        self.flip = np.array([sprite.flip for sprite in sprites], dtype=bool)
+        self.alive = np.array([sprite.alive for sprite in sprites], dtype=bool)
+        self.health = np.array([sprite.health for sprite in sprites], dtype=np.int64)
+        self.ammo = np.array([sprite.ammo for sprite in sprites], dtype=np.int64)
+        self.shoot_cooldown = np.array([sprite.shoot_cooldown for sprite in sprites], dtype=np.int64)
+        self.move_counter = np.array([sprite.move_counter for sprite in sprites], dtype=np.int64)
+        self.idling = np.array([sprite.idling for sprite in sprites], dtype=bool)
+        self.idling_counter = np.array([sprite.idling_counter for sprite in sprites], dtype=np.int64)
+        self.vision_x = np.array([sprite.vision.x for sprite in sprites], dtype=np.int64)
+        self.vision_y = np.array([sprite.vision.y for sprite in sprites], dtype=np.int64)
+        self.action = np.array([sprite.action for sprite in sprites], dtype=np.int64)
+        self.frame_index = np.array([sprite.frame_index for sprite in sprites], dtype=np.int64)
+        self.update_time = np.array([sprite.update_time for sprite in sprites], dtype=np.int64)
+        # Every enemy uses the same animations, so one table of frame counts does for all of them
+        self.num_of_frames = np.array([len(frames) for frames in sprites[0].animation_list] if sprites else [1], dtype=np.int64)
+
+    def flush(self):
+        # Bullets and grenades take health off the sprites, so it is read back from them before
+        # the arrays are copied over the sprites
+        if self.sprites:
+            self.health = np.fromiter((sprite.health for sprite in self.sprites), dtype=np.int64, count=len(self.sprites))
+        for i, sprite in enumerate(self.sprites):
+            sprite.speed = int(self.speed[i])
+            sprite.ammo = int(self.ammo[i])
+            sprite.shoot_cooldown = int(self.shoot_cooldown[i])
+            sprite.move_counter = int(self.move_counter[i])
+            sprite.idling = bool(self.idling[i])
+            sprite.idling_counter = int(self.idling_counter[i])
+            sprite.vision.topleft = (int(self.vision_x[i]), int(self.vision_y[i]))
+            sprite.update_time = int(self.update_time[i])
+        self.sync_sprites()
+
+    def wall_hits(self, x, dx, y, width, height):
+        # How many times Soldier.move's tile loop turns each enemy around. The first obstacle in
+        # the way stops the move, every obstacle after it (row by row) that the enemy is already
+        # standing in turns it around again.
+        hits = np.zeros(len(x), dtype=np.int64)
+        first_row, last_row = y // TILE_SIZE, (y + height - 1) // TILE_SIZE
+        first_col = np.minimum(x, x + dx) // TILE_SIZE
+        last_col = (np.maximum(x, x + dx) + width - 1) // TILE_SIZE
+        for row_offset in range(int((last_row - first_row).max(initial=0)) + 1):
+            for col_offset in range(int((last_col - first_col).max(initial=0)) + 1):
+                row, col = first_row + row_offset, first_col + col_offset
+                obstacle = (row <= last_row) & (col <= last_col) & self.grids.cells(self.grids.obstacle, row, col)
+                in_the_way = obstacle & (col * TILE_SIZE < x + dx + width) & ((col + 1) * TILE_SIZE > x + dx)
+                standing_in = obstacle & (col * TILE_SIZE < x + width) & ((col + 1) * TILE_SIZE > x)
+                hits += np.where(hits == 0, in_the_way, standing_in)
+        return hits
+
+    def landing_row(self, x, y, width, height):
+        # The top row with an obstacle under each rect, -1 where there is none
+        landing = np.full(len(x), -1, dtype=np.int64)
+        first_row, last_row = y // TILE_SIZE, (y + height - 1) // TILE_SIZE
+        first_col, last_col = x // TILE_SIZE, (x + width - 1) // TILE_SIZE
+        for row_offset in range(int((last_row - first_row).max(initial=0)) + 1):
+            row = first_row + row_offset
+            hit = np.zeros(len(x), dtype=bool)
+            for col_offset in range(int((last_col - first_col).max(initial=0)) + 1):
+                col = first_col + col_offset
+                hit |= (col <= last_col) & self.grids.cells(self.grids.obstacle, row, col)
+            landing = np.where((landing < 0) & hit & (row <= last_row), row, landing)
+        return landing
+
+    def update_action(self, mask, new_action):
+        change = mask & (self.action != new_action)
+        self.action[change] = new_action
+        self.frame_index[change] = 0
+        self.update_time[change] = game_ticks()
+
+    def ai(self, sprites):
+        # Soldier.ai for every enemy
+        if sprites != self.sprites:
+            self.load(sprites)
+        if not sprites:
+            return
+        self.grids = tile_grids()
+        # Bullets and grenades take health off the sprites
+        self.health = np.fromiter((sprite.health for sprite in sprites), dtype=np.int64, count=len(sprites))
+        if not player.alive:
+            return
+        thinking = self.alive.copy()
+
+        # Now and then stop for a bit
+        start_idling = thinking & ~self.idling
+        start_idling[start_idling] = self.random.integers(1, 201, int(start_idling.sum())) == 1
+        self.update_action(start_idling, 0)
+        self.idling |= start_idling
+        self.idling_counter[start_idling] = 50
+
+        # Stop and shoot at the player if it is in sight
+        sees = thinking & (self.vision_x < player.rect.right) & (self.vision_x + 150 > player.rect.left) & \
+            (self.vision_y < player.rect.bottom) & (self.vision_y + 20 > player.rect.top)
+        self.update_action(sees, 0)
+        shoots = sees & (self.shoot_cooldown == 0) & (self.ammo > 0)
+        self.shoot_cooldown[shoots] = 20
+        self.ammo[shoots] -= 1
+        for i in np.flatnonzero(shoots).tolist():
+            x, y, width, height, direction = int(self.x[i]), int(self.y[i]), int(self.width[i]), int(self.height[i]), int(self.direction[i])
+            fire_bullet(x + width // 2 + (0.75 * width * direction), y + height // 2, direction)
+            # The shooter's ammo shows on its sprite right away, like after Soldier.shoot
+            sprites[i].ammo = int(self.ammo[i])
+            play_fx(shot_fx)
+
+        # Count down the idling ones
+        idle = thinking & ~sees & self.idling
+        self.idling_counter[idle] -= 1
+        self.idling[idle & (self.idling_counter <= 0)] = False
+
+        # Patrol with the rest
+        walking = thinking & ~sees & ~idle
+        self.move(walking)
+        self.update_action(walking, 1)
+        self.move_counter[walking] += 1
+        self.vision_x[walking] = self.x[walking] + self.width[walking] // 2 + 75 * self.direction[walking] - 75
+        self.vision_y[walking] = self.y[walking] + self.height[walking] // 2 - 10
+        turn = walking & (self.move_counter > TILE_SIZE)
+        self.direction[turn] *= -1
+        self.move_counter[turn] *= -1
+
+    def move(self, mask):
+        # Soldier.move for walking enemies. Enemies never jump, so they can only land on something,
+        # never bump their head.
+        walking = np.flatnonzero(mask)
+        x, y, width, height = self.x[walking], self.y[walking], self.width[walking], self.height[walking]
+        direction = self.direction[walking]
+        dx = self.speed[walking] * direction
+        self.flip[walking] = direction < 0
+
+        # Apply gravity
+        vel_y = np.minimum(self.vel_y[walking] + GRAVITY, 10)
+        dy = vel_y.copy()
+
+        # Walls turn the enemy around
+        wall_hits = self.wall_hits(x, dx, y, width, height)
+        hit_wall = wall_hits > 0
+        dx[hit_wall] = 0
+        direction[wall_hits % 2 == 1] *= -1
+        self.move_counter[walking[hit_wall]] = 0
+
+        # Land on the ground, rects are tested at the truncated position like colliderect does
+        landing = self.landing_row(x, np.trunc(y + dy).astype(np.int64), width, height)
+        landed = landing >= 0
+        dy[landed] = landing[landed] * TILE_SIZE - (y[landed] + height[landed])
+        vel_y[landed] = 0
+
+        # Water and falling off the map are checked at the position before moving
+        drowned = self.grids.overlaps(self.grids.water, x, y, width, height) | (y + height > SCREEN_HEIGHT)
+        self.health[walking[drowned]] = 0
+
+        self.direction[walking] = direction
+        self.vel_y[walking] = vel_y
+        self.x[walking] = x + dx
+        self.y[walking] = rect_round(y + dy)
+
+    def update(self):
+        # Soldier.update for every enemy: animation, death and shoot cooldown
+        if not self.sprites:
+            return
+        # The image shown is picked before the animation moves on
+        image_action, image_frame = self.action.copy(), self.frame_index.copy()
+        now = game_ticks()
+        next_frame = now - self.update_time > self.ANIMATION_COOLDOWN
+        self.update_time[next_frame] = now
+        self.frame_index[next_frame] += 1
+        finished = self.frame_index >= self.num_of_frames[self.action]
+        self.frame_index[finished] = np.where(self.action[finished] == 3, self.num_of_frames[self.action[finished]] - 1, 0)
+
+        dying = self.health <= 0
+        self.health[dying] = 0
+        self.speed[dying] = 0
+        self.alive[dying] = False
+        self.update_action(dying, 3)
+
+        self.shoot_cooldown[self.shoot_cooldown > 0] -= 1
+        self.sync_sprites(image_action, image_frame)
+
+    def sync_sprites(self, image_action=None, image_frame=None):
+        # Copy what drawing, collisions and checksums look at back to the sprites
+        if not self.sprites:
+            return
+        if image_action is None:
+            image_action, image_frame = self.action, self.frame_index
+        for sprite, x, y, vel_y, direction, flip, alive, health, action, frame_index, shown_action, shown_frame in zip(
+                self.sprites, self.x.tolist(), self.y.tolist(), self.vel_y.tolist(), self.direction.tolist(),
+                self.flip.tolist(), self.alive.tolist(), self.health.tolist(), self.action.tolist(),
+                self.frame_index.tolist(), image_action.tolist(), image_frame.tolist()):
+            sprite.rect.topleft = (x, y)
+            sprite.vel_y = vel_y
+            sprite.direction = direction
+            sprite.flip = flip
+            sprite.alive = alive
+            sprite.health = health
+            sprite.action = action
+            sprite.frame_index = frame_index
+            sprite.image = sprite.animation_list[shown_action][shown_frame]
+            sprite.flipped_image = sprite.flipped_animation_list[shown_action][shown_frame]
+
+
+class LevelChunk:
+    # CHUNK_COLS columns of a level: their static tiles, collision grids and pre-rendered surfaces.
+    # Made from the level data when the camera gets close and thrown away when it is far away again.
+    def __init__(self, index, data, cleared=(), bare=False):
+        self.index = index
+        self.first_col = index * CHUNK_COLS
         self.obstacle_list = []
-    
-    def process_data(self, data):
-        self.level_length = len(data[0])  # number of columns
-        # data = world_data
-        # Iterate through each value in level data file
+        # Collision index: one entry (or None) per tile cell, indexed as grids[layer][row][column - first_col]
+        self.grids = {layer: [[None] * CHUNK_COLS for row in data] for layer in ('obstacle', 'water', 'exit')}
+        self.sprites = []  # water, decorations and exits
+        self.spawns = []  # enemies and item boxes, except the ones in cleared (killed or picked up before)
+        self.nav = None  # NavChunk, with --enemy-ai navigate
         for y, row in enumerate(data):
-            for x, tile in enumerate(row):
+            for i, tile in enumerate(row[self.first_col:self.first_col + CHUNK_COLS]):
+                x = self.first_col + i
+                if tile >= 16 and tile <= 19 and (x, y) in cleared:
+                    continue
+                if bare and tile > 8:
+                    continue  # only the ground is left of a finished level
                 if tile >= 0:
                     img = img_list[tile]
                     img_rect = img.get_rect()
@@ -379,44 +1046,507 @@ class World:
                     if tile >= 0 and tile <= 8:
                         # Obstacles
                         self.obstacle_list.append(tile_data)
+                        self.grids['obstacle'][y][i] = tile_data
                     elif tile >= 9 and tile <= 10:
                         # Water
                         water = Water(img, x * TILE_SIZE, y * TILE_SIZE)
-                        water_group.add(water)
+                        self.sprites.append(water)
+                        self.grids['water'][y][i] = water
                     elif tile >= 11 and tile <= 14:
                         # Decoration
-                        decoration = Decoration(img, x * TILE_SIZE, y * TILE_SIZE)
-                        decoration_group.add(decoration)
-                    elif tile == 15:
-                        # Create a player
-                        player = Soldier("player", x * TILE_SIZE, y * TILE_SIZE, 1.65, 5, 20, 5)
-                        health_bar = HealthBar(10, 10, player.health, player.health)
+                        self.sprites.append(Decoration(img, x * TILE_SIZE, y * TILE_SIZE))
                     elif tile == 16:
                         # Create Enemy
-                        enemy = Soldier("enemy", x * TILE_SIZE, y * TILE_SIZE, 1.65, 2, 20, 0)
-                        enemy_group.add(enemy)
+                        self.add_spawn(Soldier("enemy", x * TILE_SIZE, y * TILE_SIZE, 1.65, 2, 20, 0), x, y)
                     elif tile == 17:
                         # Create ammo box
-                        item_box = ItemBox('Ammo', x * TILE_SIZE, y * TILE_SIZE)
-                        item_box_group.add(item_box)
+                        self.add_spawn(ItemBox('Ammo', x * TILE_SIZE, y * TILE_SIZE), x, y)
                     elif tile == 18:
                         # Create Grenade box
-                        item_box = ItemBox('Grenade', x * TILE_SIZE, y * TILE_SIZE)
-                        item_box_group.add(item_box)
+                        self.add_spawn(ItemBox('Grenade', x * TILE_SIZE, y * TILE_SIZE), x, y)
                     elif tile == 19:
                         # Create Health box
-                        item_box = ItemBox('Health', x * TILE_SIZE, y * TILE_SIZE)
-                        item_box_group.add(item_box)
+                        self.add_spawn(ItemBox('Health', x * TILE_SIZE, y * TILE_SIZE), x, y)
                     elif tile == 20:
                         # Create Exit
                         exit1 = Exit(img, x * TILE_SIZE, y * TILE_SIZE)
-                        exit_group.add(exit1)
+                        self.sprites.append(exit1)
+                        self.grids['exit'][y][i] = exit1
+        self.rows = len(data)
+        self.tile_surface = self.overlay_surface = None
+        if not HEADLESS:
+            self.bake()  # headless runs mostly never draw, there the chunk is baked when it first is
+
+    def add_spawn(self, sprite, x, y):
+        sprite.spawn_cell = (x, y)  # remembered by the world if it gets killed or picked up
+        self.spawns.append(sprite)
+
+    def bake(self):
+        # Blit every static tile once, so drawing the chunk is a single blit.
+        # Decorations, water and exits go on a second surface drawn on top of the characters.
+        chunk_width = CHUNK_COLS * TILE_SIZE
+        left = self.first_col * TILE_SIZE
+        self.tile_surface = pygame.Surface((chunk_width, self.rows * TILE_SIZE), pygame.SRCALPHA)
+        self.overlay_surface = pygame.Surface((chunk_width, self.rows * TILE_SIZE), pygame.SRCALPHA)
+        for tile in self.obstacle_list:
+            self.tile_surface.blit(tile[0], (tile[1].x - left, tile[1].y))
+        for sprite in self.sprites:
+            self.overlay_surface.blit(sprite.image, (sprite.rect.x - left, sprite.rect.y))
+        self.tile_surface = self.tile_surface.convert_alpha()
+        self.overlay_surface = self.overlay_surface.convert_alpha()
+
+
+# Links of the chunks of level files, by ((path, modification time), width, height, speed), see NavGraph
+nav_links = {}
+
+
+class NavChunk:
+    # The spans of one LevelChunk: runs of cells on one row with ground under them and room for a
+    # soldier above. Spans stop at the edges of the chunk, so each one is known by (row, first column)
+    # without looking at the chunks next to it. Made and thrown away with the chunk.
+    def __init__(self, graph, index):
+        first_col = index * CHUNK_COLS
+        last_col = min(first_col + CHUNK_COLS, graph.cols) - 1
+        self.span_of = {}  # (col, row) -> span
+        self.spans = {}  # span -> (row, first_col, last_col)
+        self.links = {}  # span -> its links, filled in by NavGraph.load_chunk
+        for row in range(graph.rows):
+            col = first_col
+            while col <= last_col:
+                if graph.standable(col, row):
+                    span = (row, col)
+                    while col + 1 <= last_col and graph.standable(col + 1, row):
+                        col += 1
+                    for span_col in range(span[1], col + 1):
+                        self.span_of[(span_col, row)] = span
+                    self.spans[span] = (row, span[1], col)
+                col += 1
+
+
+class NavGraph:
+    # Where an enemy can go in a level, so the AI can look it up instead of finding out by walking
+    # into things. Every loaded chunk has a NavChunk with its spans, and what is past the end of a
+    # span is one of:
+    # - 'span': the span carries on in the next chunk, a 'walk' link
+    # - 'wall', 'drop' or 'water', or the 'edge' of the level
+    # Jumping from the end of a span or walking off it gives a 'jump' or 'drop' link to where the
+    # soldier lands, found by following the same steps as Soldier.move (GRAVITY, vel_y = -11 and the
+    # enemy's speed) through the tiles. Jumps and drops that end in water or off the map aren't links.
+    # The links of a chunk are worked out when it loads and kept for as long as the level file
+    # doesn't change, so coming back to a chunk or restarting the level costs nothing.
+    # Routes only go through loaded chunks, they are searched the first time they are asked for
+    # and remembered until a chunk they go through is unloaded.
+    MAX_FRAMES = 120  # a jump or a drop that hasn't landed by then doesn't count
+
+    def __init__(self, world, width, height, speed, source=None):
+        self.world = world
+        self.data = world.level_data
+        self.rows = world.rows
+        self.cols = world.level_length
+        self.width = width
+        self.height = height
+        self.speed = speed
+        # chunk index -> {span: links}, shared by every world made from the same level file
+        if source is not None:
+            for key in list(nav_links):
+                if key[0][0] == source[0] and key[0] != source:
+                    del nav_links[key]  # made from an older version of the file
+            self.chunk_links = nav_links.setdefault((source, width, height, speed), {})
+        else:
+            self.chunk_links = {}
+        self.routes = {}  # (from span, to span) -> first link to take, None when there is no way
+        self.chunk_routes = {}  # chunk index -> keys of the routes that go through it
+
+    def load_chunk(self, chunk):
+        chunk.nav = NavChunk(self, chunk.index)
+        if chunk.index not in self.chunk_links:
+            self.chunk_links[chunk.index] = {span: self.find_links(chunk.nav, span) for span in chunk.nav.spans}
+        chunk.nav.links = self.chunk_links[chunk.index]
+        # The new chunk may open up a way where there was none
+        self.routes = {key: link for key, link in self.routes.items() if link is not None}
+
+    def unload_chunk(self, chunk):
+        for key in self.chunk_routes.pop(chunk.index, ()):
+            self.routes.pop(key, None)
+
+    def solid(self, col, row):
+        return 0 <= col < self.cols and 0 <= row < self.rows and 0 <= self.data[row][col] <= 8
+
+    def wet(self, col, row):
+        return 0 <= col < self.cols and 0 <= row < self.rows and 9 <= self.data[row][col] <= 10
+
+    def standable(self, col, row):
+        # Ground below, and the cells a soldier's body fills are free
+        if not self.solid(col, row + 1):
+            return False
+        for body_row in range(row - (self.height - 1) // TILE_SIZE, row + 1):
+            if self.solid(col, body_row) or self.wet(col, body_row):
+                return False
+        return True
+
+    def end(self, col, row):
+        if col < 0 or col >= self.cols:
+            return 'edge'
+        if self.standable(col, row):
+            return 'span'
+        if any(self.solid(col, body_row) for body_row in range(row - (self.height - 1) // TILE_SIZE, row + 1)):
+            return 'wall'
+        if self.wet(col, row) or self.wet(col, row + 1):
+            return 'water'
+        return 'drop'
+
+    def chunk_nav(self, col):
+        chunk = self.world.chunks.get(col // CHUNK_COLS)
+        return chunk.nav if chunk is not None else None
+
+    def span_of(self, col, row):
+        # The span of a cell, worked out from the level data so it needs no chunk loaded
+        if not self.standable(col, row):
+            return None
+        first_col = col - col % CHUNK_COLS
+        while col > first_col and self.standable(col - 1, row):
+            col -= 1
+        return (row, col)
+
+    def span_at(self, rect):
+        # The span a soldier in a loaded chunk is standing on, None while it is in the air.
+        # Standing soldiers bob between touching the ground and sinking a pixel into it, as
+        # Soldier.move rounds gravity.
+        if rect.bottom % TILE_SIZE > 1:
+            return None
+        row = (rect.bottom - 2) // TILE_SIZE
+        for col in (rect.centerx // TILE_SIZE, rect.left // TILE_SIZE, (rect.right - 1) // TILE_SIZE):
+            nav = self.chunk_nav(col)
+            span = nav.span_of.get((col, row)) if nav is not None else None
+            if span is not None:
+                return span
+        return None
+
+    def links(self, span):
+        # (direction, 'walk', 'jump' or 'drop', start x, span it leads to) for every way off span
+        nav = self.chunk_nav(span[1])
+        if nav is None:
+            return []
+        return nav.links.get(span, [])
+
+    def find_links(self, nav, span):
+        # The links of a span of nav, see links()
+        row, first_col, last_col = nav.spans[span]
+        links = []
+        bottom = (row + 1) * TILE_SIZE
+        for direction, col in ((-1, first_col), (1, last_col)):
+            end = self.end(col + direction, row)
+            if end == 'edge':
+                continue
+            if end == 'span':
+                links.append((direction, 'walk', None, self.span_of(col + direction, row)))
+                continue
+            # Jump from flush against the end of the span, or walk off it once nothing holds it up
+            start_x = col * TILE_SIZE + 1 if direction == -1 else (col + 1) * TILE_SIZE - 1 - self.width
+            landing = self.fly(start_x, bottom, direction, -11)
+            if landing is not None and landing != span:
+                links.append((direction, 'jump', start_x, landing))
+            if end != 'wall':
+                off_x = col * TILE_SIZE - self.width if direction == -1 else (col + 1) * TILE_SIZE
+                landing = self.fly(off_x, bottom, direction, 0)
+                if landing is not None and landing != span:
+                    links.append((direction, 'drop', start_x, landing))
+        return links
+
+    def overlaps(self, left, top, right, bottom, low, high):
+        # The cells of the level that the pixels from left, top up to right, bottom overlap with a tile
+        # from low to high, row by row like World.query
+        cells = []
+        first_col, last_col = left // TILE_SIZE, (right - 1) // TILE_SIZE
+        for row in range(top // TILE_SIZE, (bottom - 1) // TILE_SIZE + 1):
+            if 0 <= row < self.rows:
+                line = self.data[row]
+                for col in range(first_col, last_col + 1):
+                    if 0 <= col < self.cols and low <= line[col] <= high:
+                        cells.append((col, row))
+        return cells
+
+    def fly(self, x, bottom, direction, vel_y):
+        # The span a soldier at x, bottom lands on, moving in direction and starting with vel_y.
+        # The same steps as Soldier.move, with the soldier's rect kept as numbers the way pygame.Rect
+        # keeps them: moving by a fraction rounds the position, testing at a fraction cuts it off.
+        width, height = self.width, self.height
+        y = bottom - height
+        for frame in range(self.MAX_FRAMES):
+            vel_y += GRAVITY
+            if vel_y > 10:
+                vel_y = 10
+            dx = direction * self.speed
+            dy = vel_y
+            landed = False
+            moved_y = y + int(dy)
+            for col, row in self.overlaps(min(x, x + dx), min(y, moved_y), max(x, x + dx) + width,
+                                          max(y, moved_y) + height, 0, 8):
+                tile_x, tile_y = col * TILE_SIZE, row * TILE_SIZE
+                if tile_x < x + dx + width and x + dx < tile_x + TILE_SIZE and tile_y < y + height and y < tile_y + TILE_SIZE:
+                    dx = 0
+                test_y = int(y + dy)
+                if tile_x < x + width and x < tile_x + TILE_SIZE and tile_y < test_y + height and test_y < tile_y + TILE_SIZE:
+                    if vel_y < 0:
+                        vel_y = 0
+                        dy = tile_y + TILE_SIZE - y
+                    elif vel_y >= 0:
+                        vel_y = 0
+                        landed = True
+                        dy = tile_y - (y + height)
+            x += dx
+            y = math.floor(y + dy + 0.5)
+            if y + height > self.rows * TILE_SIZE or self.overlaps(x, y, x + width, y + height, 9, 10):
+                return None
+            if landed:
+                row = (y + height - 2) // TILE_SIZE
+                for col in ((x + width // 2) // TILE_SIZE, x // TILE_SIZE, (x + width - 1) // TILE_SIZE):
+                    span = self.span_of(col, row)
+                    if span is not None:
+                        return span
+                return None
+        return None
+
+    def next_link(self, start, goal):
+        # First link on the shortest way from span start to span goal, None if already there or
+        # there is no way. Searched breadth first the first time, every span on the way is remembered.
+        key = (start, goal)
+        if key in self.routes:
+            return self.routes[key]
+        came_from = {start: None}
+        frontier = deque([start])
+        while frontier and goal not in came_from:
+            span = frontier.popleft()
+            for link in self.links(span):
+                if link[3] not in came_from:
+                    came_from[link[3]] = (span, link)
+                    frontier.append(link[3])
+        if goal not in came_from or goal == start:
+            self.routes[key] = None
+            return None
+        span = goal
+        chunks = {goal[1] // CHUNK_COLS}
+        while came_from[span] is not None:
+            previous, link = came_from[span]
+            chunks.add(previous[1] // CHUNK_COLS)
+            self.routes[(previous, goal)] = link
+            for index in chunks:
+                self.chunk_routes.setdefault(index, set()).add((previous, goal))
+            span = previous
+        return self.routes[key]
+
+
+class World:
+    # A level of any width, streamed in chunks. Only the chunks around the camera are loaded,
+    # so memory doesn't grow with the length of the level. With a binary level file the level
+    # data itself is memory-mapped, so even that is only read as far as the player gets.
+    def __init__(self):
+        self.level_data = []
+        self.rows = 0
+        self.level_length = 0  # number of columns
+        self.num_of_chunks = 0
+        self.chunks = {}  # chunk index -> LevelChunk, for the loaded chunks only
+        self.obstacle_list = []  # obstacles of the loaded chunks
+        # Cells of enemies killed and item boxes picked up, so they don't come back when their chunk is loaded again
+        self.cleared = set()
+        # Health of enemies that were hurt when their chunk was unloaded, by spawn cell, so they come back hurt
+        self.enemy_health = {}
+        self.parked = []  # enemies standing in chunks that aren't active, they wait there until it is
+        self.bare = False  # set by strip() once the level is finished
+        self.nav = None  # NavGraph, with --enemy-ai navigate
+        # Every world has its own sprite groups, so a level can be built in the background
+        # while another one is being played
+        self.enemy_group = pygame.sprite.Group()
+        self.bullet_group = pygame.sprite.Group()
+        self.grenade_group = pygame.sprite.Group()
+        self.explosion_group = pygame.sprite.Group()
+        self.item_box_group = pygame.sprite.Group()
+        self.decoration_group = pygame.sprite.Group()
+        self.water_group = pygame.sprite.Group()
+        self.exit_group = pygame.sprite.Group()
+    
+    def process_data(self, data, source=None):
+        self.level_data = data
+        self.rows = len(data)
+        self.level_length = len(data[0])
+        self.num_of_chunks = (self.level_length + CHUNK_COLS - 1) // CHUNK_COLS
+        self.nav = None
+        if navigate_enemies:
+            # Enemies all share one size and speed, so one graph does for all of them
+            image = animation_cache.get('enemy', 'Idle', 1.65)[0][0]
+            self.nav = NavGraph(self, image.get_width(), image.get_height(), 2, source)
+        # The player is needed right away, wherever in the level it starts
+        for y, row in enumerate(data):
+            if 15 in row:
+                x = list(row).index(15)
+                player = Soldier("player", x * TILE_SIZE, y * TILE_SIZE, 1.65, 5, 20, 5)
+                health_bar = HealthBar(10, 10, player.health, player.health)
+                break
+        self.page(0)
         return player, health_bar
 
+    def page(self, camera_x, max_loads=None):
+        # Load the chunks around the screen and unload the ones far away from it, then move enemies
+        # between the enemy group and the parked list. While playing, at most max_loads chunks get
+        # loaded per frame, nearest to the screen first, so crossing into a new chunk doesn't stall a frame.
+        chunk_width = CHUNK_COLS * TILE_SIZE
+        first_chunk = camera_x // chunk_width
+        last_chunk = (camera_x + SCREEN_WIDTH - 1) // chunk_width
+        changed = False
+        for index in list(self.chunks):
+            if index < first_chunk - EVICT_CHUNKS or index > last_chunk + EVICT_CHUNKS:
+                self.unload_chunk(index)
+                changed = True
+        missing = [index for index in range(max(first_chunk - PAGE_CHUNKS, 0), min(last_chunk + PAGE_CHUNKS, self.num_of_chunks - 1) + 1)
+                   if index not in self.chunks]
+        missing.sort(key=lambda index: max(first_chunk - index, index - last_chunk))
+        for index in missing[:max_loads]:
+            self.load_chunk(index)
+            changed = True
+        if changed:
+            self.obstacle_list = [tile for index in sorted(self.chunks) for tile in self.chunks[index].obstacle_list]
+            self.wake()
+        self.park_enemies()
+
+    def chunk_of(self, sprite):
+        return min(max(sprite.rect.centerx // (CHUNK_COLS * TILE_SIZE), 0), self.num_of_chunks - 1)
+
+    def is_active(self, index):
+        # Enemies only run around in chunks with loaded ground on both sides,
+        # so none of them can walk off the loaded part of the level
+        return index in self.chunks and (index == 0 or index - 1 in self.chunks) and \
+            (index == self.num_of_chunks - 1 or index + 1 in self.chunks)
+
+    def load_chunk(self, index):
+        chunk = LevelChunk(index, self.level_data, self.cleared, self.bare)
+        self.chunks[index] = chunk
+        if self.nav is not None:
+            self.nav.load_chunk(chunk)
+        for sprite in chunk.sprites:
+            if isinstance(sprite, Water):
+                self.water_group.add(sprite)
+            elif isinstance(sprite, Decoration):
+                self.decoration_group.add(sprite)
+            else:
+                self.exit_group.add(sprite)
+        for sprite in chunk.spawns:
+            if isinstance(sprite, Soldier):
+                sprite.health = self.enemy_health.get(sprite.spawn_cell, sprite.health)
+                self.parked.append(sprite)  # wake() lets it go once the chunk is active
+            else:
+                self.item_box_group.add(sprite)
+
+    def unload_chunk(self, index):
+        # Everything the chunk made goes, only the cells of dead enemies and taken boxes and the
+        # health of hurt enemies are kept
+        chunk = self.chunks.pop(index)
+        if self.nav is not None:
+            self.nav.unload_chunk(chunk)
+        for sprite in chunk.sprites:
+            sprite.kill()
+        for sprite in chunk.spawns:
+            if isinstance(sprite, Soldier):
+                if not sprite.alive or sprite.health <= 0:
+                    self.cleared.add(sprite.spawn_cell)
+                    self.enemy_health.pop(sprite.spawn_cell, None)
+                elif sprite.health < sprite.max_health:
+                    self.enemy_health[sprite.spawn_cell] = sprite.health
+                if sprite in self.parked:
+                    self.parked.remove(sprite)
+            elif not sprite.alive():
+                self.cleared.add(sprite.spawn_cell)
+            sprite.kill()
+
+    def strip(self):
+        # Take everything but the ground out of the level, exits included, so the player can't
+        # finish it again after the last level. The loaded chunks are made again without it.
+        self.bare = True
+        for index in list(self.chunks):
+            self.unload_chunk(index)
+        self.parked = []
+        self.page(camera.x)
+
+    def enemies_alive(self):
+        # Living enemies in the whole level: the sprites of the loaded chunks, and the enemies
+        # in the level data of the others that haven't been killed
+        alive = 0
+        for index in range(self.num_of_chunks):
+            chunk = self.chunks.get(index)
+            if chunk is not None:
+                alive += sum(1 for sprite in chunk.spawns if isinstance(sprite, Soldier) and sprite.alive)
+            elif not self.bare:
+                first_col = index * CHUNK_COLS
+                for y, row in enumerate(self.level_data):
+                    for i, tile in enumerate(row[first_col:first_col + CHUNK_COLS]):
+                        if tile == 16 and (first_col + i, y) not in self.cleared:
+                            alive += 1
+        return alive
+
+    def park_enemies(self):
+        for enemy in self.enemy_group.sprites():
+            if not self.is_active(self.chunk_of(enemy)):
+                enemy.kill()
+                self.parked.append(enemy)
+
+    def wake(self):
+        still_parked = []
+        for enemy in self.parked:
+            if self.is_active(self.chunk_of(enemy)):
+                self.enemy_group.add(enemy)
+            else:
+                still_parked.append(enemy)
+        self.parked = still_parked
+
+    def query(self, layer, rect, by_chunk=False):
+        # Yield the entries of the cells that rect touches in the 'obstacle', 'water' or 'exit' grid,
+        # in the same row by row order as the level data. Cells of chunks that aren't loaded are empty.
+        # The search is padded by one cell, so a soldier that gets snapped against a tile during its
+        # move still sees the tiles next to it.
+        # by_chunk goes chunk by chunk and then row by row instead, the order of self.obstacle_list.
+        first_col = max(rect.left // TILE_SIZE - 1, 0)
+        last_col = min(rect.right // TILE_SIZE + 1, self.level_length - 1)
+        first_row = max(rect.top // TILE_SIZE - 1, 0)
+        last_row = min(rect.bottom // TILE_SIZE + 1, self.rows - 1)
+        if by_chunk:
+            for index in range(first_col // CHUNK_COLS, last_col // CHUNK_COLS + 1):
+                chunk = self.chunks.get(index)
+                if chunk is None:
+                    continue
+                start = max(first_col, chunk.first_col) - chunk.first_col
+                end = min(last_col, chunk.first_col + CHUNK_COLS - 1) - chunk.first_col + 1
+                for row in range(first_row, last_row + 1):
+                    for entry in chunk.grids[layer][row][start:end]:
+                        if entry is not None:
+                            yield entry
+            return
+        for row in range(first_row, last_row + 1):
+            col = first_col
+            while col <= last_col:
+                chunk = self.chunks.get(col // CHUNK_COLS)
+                end_col = min(col - col % CHUNK_COLS + CHUNK_COLS - 1, last_col)
+                if chunk is not None:
+                    for entry in chunk.grids[layer][row][col - chunk.first_col:end_col - chunk.first_col + 1]:
+                        if entry is not None:
+                            yield entry
+                col = end_col + 1
+
+    def draw_chunks(self, attribute):
+        # Only the one or two chunks overlapping the screen get blitted
+        chunk_width = CHUNK_COLS * TILE_SIZE
+        first_chunk = max(camera.x // chunk_width, 0)
+        last_chunk = (camera.x + SCREEN_WIDTH - 1) // chunk_width
+        for index in range(first_chunk, last_chunk + 1):
+            chunk = self.chunks.get(index)
+            if chunk is not None:
+                if chunk.tile_surface is None:
+                    chunk.bake()
+                screen.blit(getattr(chunk, attribute), (index * chunk_width - camera.x, 0))
+
     def draw(self):
-        for tile in self.obstacle_list:
-            tile[1][0] += screen_scroll
-            screen.blit(tile[0], tile[1])  # 0 is the image and 1 is the rectangle
+        self.draw_chunks('tile_surface')
+
+    def draw_overlay(self):
+        self.draw_chunks('overlay_surface')
 
 
 class Water(pygame.sprite.Sprite):
@@ -425,9 +1555,6 @@ class Water(pygame.sprite.Sprite):
         self.image = img
         self.rect = self.image.get_rect()
         self.rect.midtop = (x + TILE_SIZE // 2, y + (TILE_SIZE - self.image.get_height()))
-    
-    def update(self):
-        self.rect.x += screen_scroll 
 
 
 class Decoration(pygame.sprite.Sprite):
@@ -436,9 +1563,6 @@ class Decoration(pygame.sprite.Sprite):
         self.image = img
         self.rect = self.image.get_rect()
         self.rect.midtop = (x + TILE_SIZE // 2, y + (TILE_SIZE - self.image.get_height()))
-    
-    def update(self):
-        self.rect.x += screen_scroll 
 
 
 class Exit(pygame.sprite.Sprite):
@@ -448,9 +1572,6 @@ class Exit(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.rect.midtop = (x + TILE_SIZE // 2, y + (TILE_SIZE - self.image.get_height()))
 
-    def update(self):
-        self.rect.x += screen_scroll 
-
 
 # Item drops
 class ItemBox(pygame.sprite.Sprite):
@@ -461,24 +1582,19 @@ class ItemBox(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.rect.midtop = (x + TILE_SIZE // 2, y + (TILE_SIZE - self.image.get_height()))
 
-    def update(self):
-        # Scroll
-        self.rect.x += screen_scroll
-        # Check if player has picked up these boxes
-        if pygame.sprite.collide_rect(self, player):
-            # Check the kind of box
-            if self.item_type == 'Health':
-                # print("Player's health before:", player.health)
-                player.health += 25
-                if player.health > player.max_health:
-                    player.health = player.max_health
-                # print("Player's health after:", player.health)
-            elif self.item_type == 'Ammo':
-                player.ammo += 15
-            elif self.item_type == 'Grenade':
-                player.grenades += 3
-            # Delete the item_box
-            self.kill()
+    def pick_up(self, soldier):
+        # Check the kind of box
+        if self.item_type == 'Health':
+            soldier.health += 25
+            if soldier.health > soldier.max_health:
+                soldier.health = soldier.max_health
+        elif self.item_type == 'Ammo':
+            soldier.ammo += 15
+        elif self.item_type == 'Grenade':
+            soldier.grenades += 3
+        soldier.pickups[self.item_type] += 1
+        # Delete the item_box
+        self.kill()
 
 
 class HealthBar:
@@ -488,60 +1604,174 @@ class HealthBar:
         self.health = health
         self.max_health = max_health
 
-    def draw(self, health):
+    def draw(self, surface, health):
         # Update with new health
         self.health = health
         # Calculate health ratio
         ratio = self.health / self.max_health
-        pygame.draw.rect(screen, BLACK, (self.x - 2, self.y - 2, 150 + 4, 20 + 4))
-        pygame.draw.rect(screen, RED, (self.x, self.y, 150, 20))
-        pygame.draw.rect(screen, GREEN, (self.x, self.y, 150 * ratio, 20))
+        pygame.draw.rect(surface, BLACK, (self.x - 2, self.y - 2, 150 + 4, 20 + 4))
+        pygame.draw.rect(surface, RED, (self.x, self.y, 150, 20))
+        pygame.draw.rect(surface, GREEN, (self.x, self.y, 150 * ratio, 20))
 
 
-class Bullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, direction):
+class Hud:
+    # Health bar, ammo and grenades, drawn into a surface of their own that is only redrawn when one
+    # of the numbers changes. Every other frame the whole HUD is a single blit.
+    def __init__(self):
+        self.key = None
+        self.image = None
+        self.area = None
+
+    def draw(self, surface, health_bar, player):
+        key = (player.health, health_bar.max_health, player.ammo, player.grenades)
+        if key != self.key:
+            self.key = key
+            self.build(health_bar, player)
+        surface.blit(self.image, self.area.topleft, self.area)
+
+    def build(self, health_bar, player):
+        height = 60 + max(font.get_height(), grenade_img.get_height())
+        self.image = pygame.Surface((SCREEN_WIDTH, height), pygame.SRCALPHA)
+        # Show player health
+        health_bar.draw(self.image, player.health)
+
+        # Show ammo
+        # draw_text(f'AMMO: {player.ammo}', font, WHITE, 10, 35)  # Showing Numerical value on screen
+        # SHOWS NUMBER OF BULLETS BY BULLET IMAGE
+        draw_text('AMMO: ', font, WHITE, 10, 35, self.image)
+        self.image.blits([(bullet_img, (90 + (x * 10), 40)) for x in range(player.ammo)], False)
+
+        # Show grenades
+        # draw_text(f'GRENADE: {player.grenades}', font, WHITE, 10, 60)  # Showing Numerical value on screen
+        draw_text('GRENADE: ', font, WHITE, 10, 60, self.image)
+        self.image.blits([(grenade_img, (135 + (x * 15), 60)) for x in range(player.grenades)], False)
+
+        # Only the part with something on it gets blitted, run-length encoded so the gaps are skipped
+        self.area = self.image.get_bounding_rect()
+        self.image.set_alpha(255, pygame.RLEACCEL)
+
+
+hud = Hud()
+
+
+class SpatialHash:
+    # Buckets sprites by the grid cells their rects overlap, so a lookup only has to test
+    # the sprites sharing a cell with the query rect
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def clear(self):
+        self.cells.clear()
+
+    def cells_for(self, rect):
+        for x in range(rect.left // self.cell_size, (rect.right - 1) // self.cell_size + 1):
+            for y in range(rect.top // self.cell_size, (rect.bottom - 1) // self.cell_size + 1):
+                yield x, y
+
+    def insert(self, sprite):
+        for cell in self.cells_for(sprite.rect):
+            self.cells.setdefault(cell, []).append(sprite)
+
+    def query(self, rect):
+        # Sprites whose rect collides with rect, each reported once
+        found = []
+        seen = set()
+        for cell in self.cells_for(rect):
+            for sprite in self.cells.get(cell, ()):
+                if sprite not in seen and sprite.rect.colliderect(rect):
+                    seen.add(sprite)
+                    found.append(sprite)
+        return found
+
+
+class SpritePool:
+    # A fixed number of sprites made up front and recycled, so shooting and explosions
+    # don't allocate. Pooled sprites go back to the pool when they are killed.
+    def __init__(self, sprite_type, capacity, *args):
+        self.sprite_type = sprite_type
+        self.capacity = capacity
+        self.free = [sprite_type(*args) for i in range(capacity)]
+        self.in_use = 0
+        self.high_water = 0  # most sprites in use at the same time
+        self.overflow = 0  # sprites that had to be made because the pool was empty
+
+    def acquire(self, group, *args):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(*args)
+        else:
+            self.overflow += 1
+            sprite = self.sprite_type(*args)
+        sprite.pool = self
+        group.add(sprite)
+        self.in_use += 1
+        self.high_water = max(self.high_water, self.in_use)
+        return sprite
+
+    def release(self, sprite):
+        self.in_use -= 1
+        if len(self.free) < self.capacity:
+            self.free.append(sprite)
+
+    def release_all(self, group):
+        # group.empty() would drop the sprites without giving them back
+        for sprite in group.sprites():
+            sprite.kill()
+
+    def stats(self):
+        return {'capacity': self.capacity, 'in_use': self.in_use, 'high_water': self.high_water,
+                'overflow': self.overflow}
+
+
+class PooledSprite(pygame.sprite.Sprite):
+    def __init__(self):
         pygame.sprite.Sprite.__init__(self)
+        self.pool = None
+
+    def kill(self):
+        # Only the first kill() of a live sprite hands it back to its pool
+        if self.alive():
+            pygame.sprite.Sprite.kill(self)
+            if self.pool is not None:
+                self.pool.release(self)
+
+
+class Bullet(PooledSprite):
+    def __init__(self, x, y, direction):
+        PooledSprite.__init__(self)
         self.speed = 10
         self.image = bullet_img
         self.rect = self.image.get_rect()
+        self.reset(x, y, direction)
+
+    def reset(self, x, y, direction):
         self.rect.center = (x, y)
         self.direction = direction
 
     def update(self):
         # Move bullet
-        self.rect.x += (self.direction * self.speed) + screen_scroll
+        self.rect.x += (self.direction * self.speed)
         # Check if bullets has gone off screen
-        if self.rect.right < 0 or self.rect.left > SCREEN_WIDTH:
+        if not camera.can_see(self.rect):
             self.kill()  # This will delete the instance
-        # Check with collision with level
-        for tile in world.obstacle_list:
-            if tile[1].colliderect(self.rect):
-                self.kill()
-        
-        # Check collisions with character
-        if pygame.sprite.spritecollide(player, bullet_group, False):
-            if player.alive:
-                player.health -= 5
-                self.kill()  # delete the bullet
-        for enemy in enemy_group:
-            if pygame.sprite.spritecollide(enemy, bullet_group, False):
-                if enemy.alive:
-                    enemy.health -= 25
-                    # print(enemy.health) 
-                    self.kill()  # delete the bullet
+        # Hits on the level and on characters are resolved for all bullets at once in check_collisions()
 
 
-class Grenade(pygame.sprite.Sprite):
+class Grenade(PooledSprite):
     def __init__(self, x, y, direction):
-        pygame.sprite.Sprite.__init__(self)
-        self.timer = 100
-        self.vel_y = -11  # vertical
-        self.speed = 7  # horizontal, how far it will move left or right
+        PooledSprite.__init__(self)
         self.image = grenade_img
         self.rect = self.image.get_rect()
-        self.rect.center = (x, y)
         self.width = self.image.get_width()
         self.height = self.image.get_height()
+        self.reset(x, y, direction)
+
+    def reset(self, x, y, direction):
+        self.timer = 100
+        self.vel_y = -11  # vertical
+        self.speed = 7  # horizontal, how far it will move left or right
+        self.rect.center = (x, y)
         self.direction = direction
 
     def update(self):
@@ -550,7 +1780,10 @@ class Grenade(pygame.sprite.Sprite):
         dy = self.vel_y
 
         # Check for collision with level
-        for tile in world.obstacle_list:
+        # Only the tiles in the cells the grenade can reach this frame are looked up, in the order
+        # of world.obstacle_list so bounces come out the same. A bounce can reverse dx.
+        search_rect = self.rect.inflate(self.speed * 2, 0).union(self.rect.move(0, dy))
+        for tile in world.query('obstacle', search_rect, by_chunk=True):
             # Check collisions with the walls
             if tile[1].colliderect(self.rect.x + dx, self.rect.y, self.width, self.height):
                 self.direction *= -1
@@ -568,37 +1801,37 @@ class Grenade(pygame.sprite.Sprite):
                     self.vel_y = 0
                     dy = tile[1].top - self.rect.bottom
         # Update granade position
-        self.rect.x += dx + screen_scroll
+        self.rect.x += dx
         self.rect.y += dy
     
         # Coundown timer
         self.timer -= 1
         if self.timer <= 0:
             self.kill()
-            grenade_fx.play()
-            explosion = Explosion(self.rect.x, self.rect.y, 0.5)
-            explosion_group.add(explosion)
-            # Do damage to anyone nearby
-            if abs(self.rect.centerx - player.rect.centerx) < TILE_SIZE * 2 and \
-                abs(self.rect.centery - player.rect.centery) < TILE_SIZE * 2:
-                # Player in range of the blast
-                player.health -= 50
-            for enemy in enemy_group:
-                if abs(self.rect.centerx - enemy.rect.centerx) < TILE_SIZE * 2 and \
-                    abs(self.rect.centery - enemy.rect.centery) < TILE_SIZE * 2:
-                    # Enemy in range of the blast
-                    enemy.health -= 50
-                    # print(enemy.health)               
-
-
-class Explosion(pygame.sprite.Sprite):
+            play_fx(grenade_fx)
+            explosion_pool.acquire(explosion_group, self.rect.x, self.rect.y, 0.5)
+            # Do damage to anyone nearby, only the soldiers bucketed around the blast are checked
+            blast_rect = pygame.Rect(0, 0, TILE_SIZE * 4, TILE_SIZE * 4)
+            blast_rect.center = self.rect.center
+            for soldier in soldiers_near(blast_rect):
+                if abs(self.rect.centerx - soldier.rect.centerx) < TILE_SIZE * 2 and \
+                    abs(self.rect.centery - soldier.rect.centery) < TILE_SIZE * 2:
+                    # Soldier in range of the blast
+                    soldier.hurt(50, 'grenade')
+
+
+class Explosion(PooledSprite):
     def __init__(self, x, y, scale):
-        pygame.sprite.Sprite.__init__(self)
-        self.images = []
-        for num in range(1, 6):
-            img = pygame.image.load(f'img/explosion/exp{num}.png').convert_alpha()
-            img = pygame.transform.scale(img, (int(img.get_width() * scale), int(img.get_height() * scale)))
-            self.images.append(img)
+        PooledSprite.__init__(self)
+        self.scale = None
+        self.reset(x, y, scale)
+
+    def reset(self, x, y, scale):
+        # Frames come from the cache, they are decoded once when the explosion pool is made.
+        # A pooled explosion keeps its frames, so they are only looked up again for another scale.
+        if scale != self.scale:
+            self.scale = scale
+            self.images = animation_cache.get_explosion(scale)
         self.frame_index = 0
         self.image = self.images[self.frame_index]
         self.rect = self.image.get_rect()
@@ -607,8 +1840,6 @@ class Explosion(pygame.sprite.Sprite):
 
     # overrides existing update method in Sprite class
     def update(self):
-        # Scroll
-        self.rect.x += screen_scroll
         EXPLOSION_SPEED = 4
         # Update explosion animation
         self.counter += 1
@@ -625,6 +1856,196 @@ class Explosion(pygame.sprite.Sprite):
             
 
 
+class ProjectileSystem:
+    # Every live bullet and grenade in packed NumPy arrays, moved, collided and drawn in batches
+    # instead of one sprite at a time. Follows the same rules as Bullet, Grenade and the bullet
+    # part of check_collisions(). Explosions are still pooled sprites.
+    # The arrays have room for more projectiles than are flying, so firing one is a write into the
+    # spare room instead of a copy of every array. When they are full they are made twice as long.
+    # bullet_x, grenade_timer and so on are views of the rows in use.
+    BULLET_SPEED = 10  # same as Bullet.speed
+    CAPACITY = 16  # rows the arrays start with
+
+    def __init__(self):
+        self.bullet_rect = bullet_img.get_rect()
+        self.grenade_rect = grenade_img.get_rect()
+        self.clear()
+
+    def clear(self):
+        self.bullets = 0  # bullets flying, the first rows of the bullet arrays
+        self.bullet_arrays = {name: np.zeros(self.CAPACITY, dtype=np.int64) for name in ('x', 'y', 'direction')}
+        self.grenades = 0
+        self.grenade_arrays = {name: np.zeros(self.CAPACITY, dtype=np.float64 if name == 'vel_y' else np.int64)
+                               for name in ('x', 'y', 'vel_y', 'speed', 'direction', 'timer')}
+        self.make_views()
+
+    def make_views(self):
+        for name, array in self.bullet_arrays.items():
+            setattr(self, f'bullet_{name}', array[:self.bullets])
+        for name, array in self.grenade_arrays.items():
+            setattr(self, f'grenade_{name}', array[:self.grenades])
+
+    def add(self, arrays, row, values):
+        # Write values into row of arrays, doubling the arrays first if they are full
+        if row == len(arrays['x']):
+            for name, array in arrays.items():
+                arrays[name] = np.concatenate((array, np.zeros_like(array)))
+        for name, value in values.items():
+            arrays[name][row] = value
+
+    def keep(self, arrays, count, keep):
+        # Move the rows to keep to the front, returns how many there are
+        kept = int(np.count_nonzero(keep))
+        for array in arrays.values():
+            array[:kept] = array[:count][keep]
+        return kept
+
+    def fire(self, x, y, direction):
+        # Placed like Bullet.reset does it
+        self.bullet_rect.center = (x, y)
+        self.add(self.bullet_arrays, self.bullets, {'x': self.bullet_rect.x, 'y': self.bullet_rect.y, 'direction': direction})
+        self.bullets += 1
+        self.make_views()
+
+    def throw(self, x, y, direction):
+        # Same start as Grenade.reset
+        self.grenade_rect.center = (x, y)
+        self.add(self.grenade_arrays, self.grenades, {'x': self.grenade_rect.x, 'y': self.grenade_rect.y, 'vel_y': -11,
+                                                      'speed': 7, 'direction': direction, 'timer': 100})
+        self.grenades += 1
+        self.make_views()
+
+    def keep_bullets(self, keep):
+        self.bullets = self.keep(self.bullet_arrays, self.bullets, keep)
+        self.make_views()
+
+    def keep_grenades(self, keep):
+        self.grenades = self.keep(self.grenade_arrays, self.grenades, keep)
+        self.make_views()
+
+    def update_bullets(self):
+        # Move the bullets and drop the ones that left the screen
+        self.bullet_x += self.bullet_direction * self.BULLET_SPEED
+        self.keep_bullets((self.bullet_x + self.bullet_rect.width > camera.x) & (self.bullet_x < camera.x + SCREEN_WIDTH))
+
+    def collide_bullets(self, soldiers):
+        # Bullets stop at the level, or damage the first soldier they touch in the order
+        # check_collisions()'s spatial hash would have found it: by grid cell, then by soldiers' order
+        if not len(self.bullet_x):
+            return
+        grids = tile_grids()
+        x, y = self.bullet_x, self.bullet_y
+        width, height = self.bullet_rect.size
+        hit_level = grids.overlaps(grids.obstacle, x, y, width, height)
+        hit = np.zeros(len(x), dtype=bool)
+        if soldiers:
+            soldier_x = np.array([soldier.rect.x for soldier in soldiers], dtype=np.int64)
+            soldier_y = np.array([soldier.rect.y for soldier in soldiers], dtype=np.int64)
+            soldier_width = np.array([soldier.rect.width for soldier in soldiers], dtype=np.int64)
+            soldier_height = np.array([soldier.rect.height for soldier in soldiers], dtype=np.int64)
+            # One row per bullet, one column per soldier
+            touching = ~hit_level[:, None] & \
+                (x[:, None] < soldier_x + soldier_width) & (x[:, None] + width > soldier_x) & \
+                (y[:, None] < soldier_y + soldier_height) & (y[:, None] + height > soldier_y)
+            hit = touching.any(axis=1)
+            if hit.any():
+                first_col, first_row = x // TILE_SIZE, y // TILE_SIZE
+                rows = (y + height - 1) // TILE_SIZE - first_row + 1
+                shared_col = np.maximum(first_col[:, None], soldier_x // TILE_SIZE)
+                shared_row = np.maximum(first_row[:, None], soldier_y // TILE_SIZE)
+                cell = (shared_col - first_col[:, None]) * rows[:, None] + shared_row - first_row[:, None]
+                order = np.where(touching, cell * len(soldiers) + np.arange(len(soldiers)), np.iinfo(np.int64).max)
+                for target in order.argmin(axis=1)[hit].tolist():
+                    soldier = soldiers[target]
+                    soldier.hurt(5 if soldier is player else 25, 'bullet')
+        self.keep_bullets(~(hit_level | hit))
+
+    def update_grenades(self):
+        # Grenade.update for every grenade
+        if not len(self.grenade_x):
+            return
+        grids = tile_grids()
+        width, height = self.grenade_rect.size
+        x, y = self.grenade_x, self.grenade_y
+        self.grenade_vel_y += GRAVITY
+        vel_y, speed, direction = self.grenade_vel_y, self.grenade_speed, self.grenade_direction
+        dx = direction * speed
+        dy = vel_y.copy()
+
+        # Bounce off the obstacles around each grenade, visiting them in the order Grenade.update
+        # walks world.obstacle_list: chunk by chunk, then row by row
+        first_col, last_col = (x - speed) // TILE_SIZE, (x + speed + width - 1) // TILE_SIZE
+        first_row = (y + np.minimum(np.floor(dy), 0).astype(np.int64)) // TILE_SIZE - 1
+        last_row = (y + np.maximum(np.ceil(dy), 0).astype(np.int64) + height - 1) // TILE_SIZE + 1
+        first_chunk = first_col // CHUNK_COLS
+        for chunk_offset in range(int((last_col // CHUNK_COLS - first_chunk).max()) + 1):
+            for row_offset in range(int((last_row - first_row).max()) + 1):
+                for col_offset in range(int((last_col - first_col).max()) + 1):
+                    row, col = first_row + row_offset, first_col + col_offset
+                    tile = (row <= last_row) & (col <= last_col) & (col // CHUNK_COLS == first_chunk + chunk_offset) & \
+                        grids.cells(grids.obstacle, row, col)
+                    if not tile.any():
+                        continue
+                    left, top = col * TILE_SIZE, row * TILE_SIZE
+                    # Walls send it back the other way
+                    wall = tile & (left < x + dx + width) & (left + TILE_SIZE > x + dx) & (top < y + height) & (top + TILE_SIZE > y)
+                    direction = np.where(wall, -direction, direction)
+                    dx = np.where(wall, direction * speed, dx)
+                    # Hitting the roof or the ground stops it moving sideways
+                    test_y = np.trunc(y + dy)
+                    ground = tile & (left < x + width) & (left + TILE_SIZE > x) & (top < test_y + height) & (top + TILE_SIZE > test_y)
+                    speed = np.where(ground, 0, speed)
+                    dy = np.where(ground & (vel_y < 0), top + TILE_SIZE - y, np.where(ground, top - (y + height), dy))
+                    vel_y = np.where(ground, 0, vel_y)
+        self.grenade_x[:] = x + dx
+        self.grenade_y[:] = rect_round(y + dy)
+        self.grenade_vel_y[:], self.grenade_speed[:], self.grenade_direction[:] = vel_y, speed, direction
+
+        # Coundown timer
+        self.grenade_timer -= 1
+        exploding = self.grenade_timer <= 0
+        if exploding.any():
+            self.explode(self.grenade_x[exploding], self.grenade_y[exploding])
+            self.keep_grenades(~exploding)
+
+    def explode(self, x, y):
+        for grenade_x, grenade_y in zip(x.tolist(), y.tolist()):
+            play_fx(grenade_fx)
+            explosion_pool.acquire(explosion_group, grenade_x, grenade_y, 0.5)
+        # Do damage to anyone nearby, 50 for every blast they are in
+        center_x = x + self.grenade_rect.width // 2
+        center_y = y + self.grenade_rect.height // 2
+        blasts = np.count_nonzero((np.abs(center_x - player.rect.centerx) < TILE_SIZE * 2) &
+                                  (np.abs(center_y - player.rect.centery) < TILE_SIZE * 2))
+        if blasts:
+            player.hurt(50 * int(blasts), 'grenade')
+        enemies = enemy_group.sprites()
+        if enemies:
+            enemy_x = np.array([enemy.rect.centerx for enemy in enemies], dtype=np.int64)
+            enemy_y = np.array([enemy.rect.centery for enemy in enemies], dtype=np.int64)
+            blasts = np.count_nonzero((np.abs(center_x[None, :] - enemy_x[:, None]) < TILE_SIZE * 2) &
+                                      (np.abs(center_y[None, :] - enemy_y[:, None]) < TILE_SIZE * 2), axis=1)
+            for i in np.flatnonzero(blasts).tolist():
+                enemies[i].hurt(50 * int(blasts[i]), 'grenade')
+
+    def draw(self, surface):
+        # Bullets then grenades, in one blits() call
+        x = np.concatenate((self.bullet_x, self.grenade_x))
+        y = np.concatenate((self.bullet_y, self.grenade_y))
+        images = [bullet_img] * len(self.bullet_x) + [grenade_img] * len(self.grenade_x)
+        right = x + np.array([bullet_img.get_width()] * len(self.bullet_x) + [grenade_img.get_width()] * len(self.grenade_x), dtype=np.int64)
+        visible = ((right > camera.x) & (x < camera.x + SCREEN_WIDTH)).tolist()
+        surface.blits([(image, (left - camera.x, top)) for image, left, top, seen in zip(images, x.tolist(), y.tolist(), visible) if seen], False)
+
+    def checksum_values(self):
+        values = []
+        for x, y, direction in zip(self.bullet_x.tolist(), self.bullet_y.tolist(), self.bullet_direction.tolist()):
+            values += [x, y, direction]
+        for x, y, timer in zip(self.grenade_x.tolist(), self.grenade_y.tolist(), self.grenade_timer.tolist()):
+            values += [x, y, timer]
+        return values
+
+
 class ScreenFade:
     def __init__(self, direction, colour, speed):
         self.direction = direction
@@ -647,6 +2068,121 @@ class ScreenFade:
         return fade_complete
 
 
+class FrameProfiler:
+    # Times each stage of the game loop. F3 shows a frame-time graph, the per-stage breakdown
+    # and entity counts on screen, and the timings of every frame can be streamed to a CSV or
+    # JSON lines file. While it is off, mark() returns straight away.
+    STAGES = ['player update', 'enemy ai', 'enemy update', 'bullets update', 'grenades update',
+              'explosions update', 'collisions', 'player move', 'level paging', 'draw_bg', 'world draw', 'hud draw',
+              'soldiers draw', 'bullets draw', 'grenades draw', 'explosions draw', 'items draw',
+              'overlay draw', 'fades', 'events', 'display update']
+    GRAPH_WIDTH = 240
+    GRAPH_HEIGHT = 60
+
+    def __init__(self):
+        self.enabled = False  # overlay on screen
+        self.active = False  # timing anything at all
+        self.out_file = None
+        self.writer = None
+        self.frame = 0
+        self.stage_times = {}
+        self.frame_times = deque(maxlen=self.GRAPH_WIDTH)
+        self.last_mark = 0
+        self.frame_start = 0
+        self.drawn_rect = None  # where the overlay was drawn last
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.active = self.enabled or self.out_file is not None
+        # Switched on half way through a frame, so time the rest of it from here
+        self.start_frame()
+
+    def export(self, path):
+        # Stream every frame's timings to path, CSV unless it ends with .json (one JSON object per line)
+        self.out_file = open(path, 'w', newline='')
+        if not path.endswith('.json'):
+            self.writer = csv.writer(self.out_file)
+            self.writer.writerow(['frame', 'frame_ms'] + [f'{stage}_ms' for stage in self.STAGES] + ['enemies', 'bullets', 'grenades', 'explosions', 'items'])
+        self.active = True
+
+    def close(self):
+        if self.out_file:
+            self.out_file.close()
+            self.out_file = None
+        self.active = self.enabled
+
+    def start_frame(self):
+        if self.active:
+            self.stage_times = dict.fromkeys(self.STAGES, 0.0)
+            self.frame_start = self.last_mark = time.perf_counter()
+
+    def mark(self, stage):
+        # Ends stage, it gets the time since the previous mark. Called several times a frame it adds up.
+        if self.active:
+            now = time.perf_counter()
+            self.stage_times[stage] += now - self.last_mark
+            self.last_mark = now
+
+    def end_frame(self):
+        if not self.active:
+            return
+        frame_time = time.perf_counter() - self.frame_start
+        self.frame_times.append(frame_time)
+        self.frame += 1
+        if self.out_file:
+            counts = self.entity_counts()
+            if self.writer:
+                self.writer.writerow([self.frame, round(frame_time * 1000, 4)] +
+                                     [round(self.stage_times[stage] * 1000, 4) for stage in self.STAGES] + list(counts.values()))
+            else:
+                self.out_file.write(json.dumps({'frame': self.frame, 'frame_ms': frame_time * 1000,
+                                                'stages_ms': {stage: t * 1000 for stage, t in self.stage_times.items()},
+                                                'entities': counts}) + '\n')
+
+    def entity_counts(self):
+        bullets, grenades = len(bullet_group), len(grenade_group)
+        if projectile_system is not None:
+            bullets, grenades = len(projectile_system.bullet_x), len(projectile_system.grenade_x)
+        return {'enemies': len(enemy_group), 'bullets': bullets, 'grenades': grenades,
+                'explosions': len(explosion_group), 'items': len(item_box_group)}
+
+    def draw(self, surface):
+        if not self.enabled:
+            return
+        x = SCREEN_WIDTH - self.GRAPH_WIDTH - 10
+        y = 10
+        panel = pygame.Surface((self.GRAPH_WIDTH, 340), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        drawn = [surface.blit(panel, (x, y))]
+        # Frame-time graph, one column per frame, the line marks the 60 FPS budget
+        budget = 1 / FPS
+        for i, frame_time in enumerate(self.frame_times):
+            height = min(int(frame_time / (budget * 2) * self.GRAPH_HEIGHT), self.GRAPH_HEIGHT)
+            colour = GREEN if frame_time <= budget else RED
+            pygame.draw.line(surface, colour, (x + i, y + self.GRAPH_HEIGHT), (x + i, y + self.GRAPH_HEIGHT - height))
+        drawn.append(pygame.draw.line(surface, WHITE, (x, y + self.GRAPH_HEIGHT // 2), (x + self.GRAPH_WIDTH, y + self.GRAPH_HEIGHT // 2)))
+        # The slowest stages of the last frame
+        text_y = y + self.GRAPH_HEIGHT + 5
+        last_frame = self.frame_times[-1] if self.frame_times else 0
+        lines = [f'frame {last_frame * 1000:.2f} ms  fps {clock.get_fps():.0f}']
+        for stage, t in sorted(self.stage_times.items(), key=lambda item: item[1], reverse=True)[:10]:
+            lines.append(f'{stage}: {t * 1000:.2f} ms')
+        counts = [f'{name} {count}' for name, count in self.entity_counts().items()]
+        lines += ['  '.join(counts[:3]), '  '.join(counts[3:])]
+        if ai_scheduler is not None:
+            lines.append('  '.join(f'{tier} {count}' for tier, count in ai_scheduler.tiers.items()))
+        if line_of_sight is not None:
+            lines.append(f'sight rays {line_of_sight.counts["rays"]}  cached {line_of_sight.counts["cached"]}')
+        for line in lines:
+            drawn.append(surface.blit(profiler_font.render(line, True, WHITE), (x + 5, text_y)))
+            text_y += 22
+        self.drawn_rect = drawn[0].unionall(drawn[1:])  # the text can run past the panel
+
+
+profiler = FrameProfiler()
+profiler_font = pygame.font.SysFont('Futura', 20)
+
+
 # Create screen fade
 intro_fade = ScreenFade(1, BLACK, 4)
 death_fade = ScreenFade(2, PINK, 4)
@@ -682,210 +2218,807 @@ start_button = Button(SCREEN_WIDTH // 2 - 130, SCREEN_HEIGHT // 2 - 150, start_i
 exit_button = Button(SCREEN_WIDTH // 2 - 110, SCREEN_HEIGHT // 2 + 50, exit_img, 1)
 restart_button = Button(SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT // 2 - 50, restart_img, 2)
 
-# Create sprite groups
-enemy_group = pygame.sprite.Group() 
-bullet_group = pygame.sprite.Group() 
-grenade_group = pygame.sprite.Group()
-explosion_group = pygame.sprite.Group()
-item_box_group = pygame.sprite.Group()
-decoration_group = pygame.sprite.Group()
-water_group = pygame.sprite.Group()
-exit_group = pygame.sprite.Group()
-
-
-# Create Empty tile list
-world_data = []
-for row in range(ROWS):
-    r = [-1] * COLS
-    world_data.append(r)
-# print(r)  # INDIVIDUAL 150 LISTs of value = -1 each
-# print(world_data)  # 16 * 150 entries
-
-# Load in level data and create world
-with open(f'level{level}_data.csv', newline='') as csvfile:
-    reader = csv.reader(csvfile, delimiter=',')
-    for x, row in enumerate(reader):
-        # x is the row index
-        for y, tile in enumerate(row):
-            # y is the column index
-            world_data[x][y] = int(tile)  # as the value returned from csv file will be string
-
-# print(world_data)
-
+# Sprite groups of the world being played, activate_world() points these at the groups of a new world
 world = World()
-player, health_bar = world.process_data(world_data)
+enemy_group = world.enemy_group
+bullet_group = world.bullet_group
+grenade_group = world.grenade_group
+explosion_group = world.explosion_group
+item_box_group = world.item_box_group
+decoration_group = world.decoration_group
+water_group = world.water_group
+exit_group = world.exit_group
+# Projectiles and effects are recycled instead of allocated, the explosion frames get loaded here
+bullet_pool = SpritePool(Bullet, 64, 0, 0, 1)
+grenade_pool = SpritePool(Grenade, 16, 0, 0, 1)
+explosion_pool = SpritePool(Explosion, 16, 0, 0, 0.5)
+# Characters, dead or alive, and pickups, re-bucketed every frame by check_collisions()
+dynamic_hash = SpatialHash(TILE_SIZE)
+# Set to an EnemyEngine to run all the enemies at once with NumPy (--enemy-engine numpy)
+enemy_engine = None
+# Set to an AiScheduler to only let the enemies near the screen think every frame (--ai-budget)
+ai_scheduler = None
+# Set to a LineOfSight to stop the enemies seeing the player through walls (--enemy-vision raycast)
+line_of_sight = None
+# Set to True to move the enemies with the level's NavGraph instead of the blind patrol (--enemy-ai navigate)
+navigate_enemies = False
+# Set to a ProjectileSystem to run bullets and grenades in batches with NumPy (--projectiles numpy)
+projectile_system = None
+# Set to a DirtyRects to only update the parts of the display that changed (--dirty-rects)
+dirty_rects = None
+
+
+def fire_bullet(x, y, direction):
+    if projectile_system is not None:
+        projectile_system.fire(x, y, direction)
+    else:
+        bullet_pool.acquire(bullet_group, x, y, direction)
 
-# ------------------------------------------  GAME LOOP  ------------------------------------------
-run = True
-while run:
-
-    clock.tick(FPS)
-
-    if start_game == False:
-        # Main Menu
-        screen.fill(BG)
-        # Add buttons
-        if start_button.draw(screen):
-            start_game = True
-            start_intro = True
-        if exit_button.draw(screen):
-            run = False
-        
+
+def throw_grenade(x, y, direction):
+    if projectile_system is not None:
+        projectile_system.throw(x, y, direction)
     else:
-        # Update Background
-        draw_bg()  # On every iteration, it will set the background colour and will override the trails
-        # Draw world map
-        world.draw()
-        # Show player health
-        health_bar.draw(player.health)
+        grenade_pool.acquire(grenade_group, x, y, direction)
 
-        # Show ammo
-        # draw_text(f'AMMO: {player.ammo}', font, WHITE, 10, 35)  # Showing Numerical value on screen
-        # SHOWS NUMBER OF BULLETS BY BULLET IMAGE
-        draw_text('AMMO: ', font, WHITE, 10, 35)
-        for x in range(player.ammo):
-            screen.blit(bullet_img, (90 + (x * 10), 40))
 
-        # Show grenades
-        # draw_text(f'GRENADE: {player.grenades}', font, WHITE, 10, 60)  # Showing Numerical value on screen
-        draw_text('GRENADE: ', font, WHITE, 10, 60)
-        for x in range(player.grenades):
-            screen.blit(grenade_img, (135 + (x * 15), 60))
+def soldiers_near(rect):
+    # Soldiers, dead or alive, whose rect touches rect. They are looked up in the dynamic hash of
+    # the last check_collisions(). Nobody moves a tile in a frame, so searching a tile further
+    # out finds every soldier, wherever it has moved since it was bucketed.
+    return [sprite for sprite in dynamic_hash.query(rect.inflate(TILE_SIZE * 2, TILE_SIZE * 2))
+            if isinstance(sprite, Soldier) and sprite.rect.colliderect(rect)]
+
 
-        player.update()
-        player.draw()
+def check_collisions():
+    # Broad phase: bucket the moving sprites once, then every bullet and the player
+    # only look at what shares their cells
+    dynamic_hash.clear()
+    if projectile_system is not None:
+        # Bullets and grenades are resolved in batches, only the player's pickups are left for the hash
+        soldiers = [player] if player.alive else []
+        projectile_system.collide_bullets(soldiers + [enemy for enemy in enemy_group if enemy.alive])
+    else:
+        # Dead soldiers too, grenade blasts still hit them next frame
+        dynamic_hash.insert(player)
+        for enemy in enemy_group:
+            dynamic_hash.insert(enemy)
+    for item_box in item_box_group:
+        dynamic_hash.insert(item_box)
 
+    for bullet in bullet_group.sprites():
+        # Check with collision with level
+        if any(tile[1].colliderect(bullet.rect) for tile in world.query('obstacle', bullet.rect)):
+            bullet.kill()
+            continue
+        # Check collisions with characters, the bullet only damages the soldier it touched
+        for sprite in dynamic_hash.query(bullet.rect):
+            if isinstance(sprite, Soldier) and sprite.alive:
+                sprite.hurt(5 if sprite is player else 25, 'bullet')
+                bullet.kill()  # delete the bullet
+                break
+
+    # Check if player has picked up any item boxes
+    for sprite in dynamic_hash.query(player.rect):
+        if isinstance(sprite, ItemBox):
+            sprite.pick_up(player)
+
+
+
+def level_path(level):
+    # The binary level file is memory-mapped, the CSV is only parsed when a level has no binary file yet
+    path = f'level{level}_data.bfl'
+    return path if os.path.exists(path) else f'level{level}_data.csv'
+
+
+def read_level(level):
+    path = level_path(level)
+    if path.endswith('.bfl'):
+        if level_format.is_stale(path, f'level{level}_data.csv'):
+            # The CSV was edited after the binary file was made from it
+            level_format.convert(f'level{level}_data.csv', path)
+        return level_format.load(path)
+    return level_format.load_csv(path)
+
+
+def prepare_world(data, source=None):
+    # Everything a level needs before it can be played, safe to run on the loader's thread.
+    # source is the (path, modification time) of the level file the data came from, if any.
+    new_world = World()
+    new_player, new_health_bar = new_world.process_data(data, source)
+    return new_world, new_player, new_health_bar
+
+
+def activate_world(new_world, new_player, new_health_bar):
+    # Swap in a prepared world, only the references to the world and its groups change
+    global world, player, health_bar
+    global enemy_group, bullet_group, grenade_group, explosion_group, item_box_group, decoration_group, water_group, exit_group
+    reset_level()  # the pooled sprites of the old world go back to their pools
+    world, player, health_bar = new_world, new_player, new_health_bar
+    enemy_group = world.enemy_group
+    bullet_group = world.bullet_group
+    grenade_group = world.grenade_group
+    explosion_group = world.explosion_group
+    item_box_group = world.item_box_group
+    decoration_group = world.decoration_group
+    water_group = world.water_group
+    exit_group = world.exit_group
+    # The soldiers may have been made a while ago, start their animations from now
+    player.update_time = game_ticks()
+    for enemy in enemy_group:
+        enemy.update_time = game_ticks()
+    camera.reset()
+
+
+class LevelLoader:
+    # Builds levels on a worker thread ahead of time, so starting the next level or restarting
+    # after a death is just swapping in a world that is already made
+    def __init__(self, background=True):
+        self.background = background
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = {}  # level -> Future of (world, player, health_bar)
+
+    def prefetch(self, *levels):
+        # Start building these levels, anything else still waiting is no longer needed
+        self.pending = {level: future for level, future in self.pending.items() if level in levels}
+        if not self.background:
+            return
+        for level in levels:
+            if level not in self.pending and level <= MAX_LEVELS:
+                self.pending[level] = self.executor.submit(build_level, level)
+
+    def take(self, level):
+        # The prepared world for level, built right now if nobody asked for it in advance
+        future = self.pending.pop(level, None)
+        if future is None:
+            return build_level(level)
+        return future.result()
+
+
+def build_level(level):
+    data = read_level(level)
+    path = level_path(level)
+    return prepare_world(data, (path, os.stat(path).st_mtime_ns))
+
+
+level_loader = LevelLoader(background=not HEADLESS)
+
+
+def load_level(level):
+    # Swap in the world for level, then get a pristine copy of it (for a restart)
+    # and the next level ready in the background
+    activate_world(*level_loader.take(level))
+    level_loader.prefetch(level, level + 1)
+
+
+def build_world(data):
+    # Create the world from a level matrix and start playing it
+    activate_world(*prepare_world(data))
+
+
+def apply_input(frame_input):
+    # Turn the input bits for this frame into the player action variables
+    global moving_left, moving_right, shoot, grenade, grenade_thrown
+    moving_left = bool(frame_input & INPUT_LEFT)
+    moving_right = bool(frame_input & INPUT_RIGHT)
+    shoot = bool(frame_input & INPUT_SHOOT)
+    grenade = bool(frame_input & INPUT_GRENADE)
+    if not grenade:
+        grenade_thrown = False
+    if frame_input & INPUT_JUMP and player.alive:
+        player.jump = True
+        play_fx(jump_fx)
+
+
+def update_game():
+    # Step the simulation by one frame, returns True when the player reached the exit
+    global grenade_thrown
+    player.update()
+    profiler.mark('player update')
+    if line_of_sight is not None:
+        line_of_sight.new_frame()
+
+    if enemy_engine is not None:
+        enemy_engine.ai(enemy_group.sprites())
+        profiler.mark('enemy ai')
+        enemy_engine.update()
+        profiler.mark('enemy update')
+    elif ai_scheduler is not None:
+        ai_scheduler.update(enemy_group.sprites())
+        profiler.mark('enemy ai')
+    else:
         for enemy in enemy_group:
             enemy.ai()
+            profiler.mark('enemy ai')
             enemy.update()
-            enemy.draw()
-
-        # update and draw groups
+            profiler.mark('enemy update')
+
+    # update groups
+    if projectile_system is not None:
+        projectile_system.update_bullets()
+        profiler.mark('bullets update')
+        projectile_system.update_grenades()
+        profiler.mark('grenades update')
+    else:
         bullet_group.update()
+        profiler.mark('bullets update')
         grenade_group.update()
-        explosion_group.update()
-        item_box_group.update()
-        decoration_group.update()
-        water_group.update()
-        exit_group.update()
-
-        bullet_group.draw(screen)
-        grenade_group.draw(screen)
-        explosion_group.draw(screen)
-        item_box_group.draw(screen)
-        decoration_group.draw(screen)
-        water_group.draw(screen)
-        exit_group.draw(screen)
-
-        # Show intro
-        if start_intro == True:
-            if intro_fade.fade():
-                start_intro = False
-                intro_fade.fade_counter = 0
-
-
-        if player.alive:
-            # update player actions
-            if shoot:
-                player.shoot()
-            # Thorw grenades
-            elif grenade and grenade_thrown == False and player.grenades > 0:
-                grenade = Grenade(player.rect.centerx + (0.5 * player.rect.size[0] * player.direction), \
-                                player.rect.top, player.direction)
-                grenade_group.add(grenade)
-                # Reduce grenades
-                player.grenades -= 1
-                grenade_thrown = True
-                # print(player.grenades)           
-
-            if player.in_air:
-                player.update_action(2)  # 2 means the third item in the list - means jump
-            elif moving_left or moving_right:
-                player.update_action(1)  # 1 means second item in self.animation_list[] - means running image list
+        profiler.mark('grenades update')
+    explosion_group.update()
+    profiler.mark('explosions update')
+    check_collisions()
+    profiler.mark('collisions')
+
+    level_complete = False
+    if player.alive:
+        # update player actions
+        if shoot:
+            player.shoot()
+        # Thorw grenades
+        elif grenade and grenade_thrown == False and player.grenades > 0:
+            throw_grenade(player.rect.centerx + (0.5 * player.rect.size[0] * player.direction), \
+                          player.rect.top, player.direction)
+            # Reduce grenades
+            player.grenades -= 1
+            grenade_thrown = True
+
+        if player.in_air:
+            player.update_action(2)  # 2 means the third item in the list - means jump
+        elif moving_left or moving_right:
+            player.update_action(1)  # 1 means second item in self.animation_list[] - means running image list
+        else:
+            player.update_action(0)  # 0 means first item in self.animation_list[] - means idle image list
+        scroll, level_complete = player.move(moving_left, moving_right)
+        camera.scroll(scroll)  # only the camera moves, the level stays where it is
+    profiler.mark('player move')
+    world.page(camera.x, 1)
+    profiler.mark('level paging')
+    return level_complete
+
+
+def draw_game():
+    # Update Background
+    draw_bg()  # On every iteration, it will set the background colour and will override the trails
+    profiler.mark('draw_bg')
+    # Draw world map
+    world.draw()
+    profiler.mark('world draw')
+    # Show player health, ammo and grenades
+    hud.draw(screen, health_bar, player)
+    profiler.mark('hud draw')
+
+    player.draw()
+    for enemy in enemy_group:
+        if camera.can_see(enemy.rect):
+            enemy.draw()
+    profiler.mark('soldiers draw')
+
+    # draw groups
+    if projectile_system is not None:
+        projectile_system.draw(screen)
+        profiler.mark('bullets draw')
+    else:
+        camera.draw_group(screen, bullet_group)
+        profiler.mark('bullets draw')
+        camera.draw_group(screen, grenade_group)
+    profiler.mark('grenades draw')
+    camera.draw_group(screen, explosion_group)
+    profiler.mark('explosions draw')
+    camera.draw_group(screen, item_box_group)
+    profiler.mark('items draw')
+    world.draw_overlay()
+    profiler.mark('overlay draw')
+
+
+def step_game(frame_input):
+    # One frame of game logic, the same for the game loop, headless runs and replays
+    global frame_count
+    if frame_input & INPUT_RESTART:
+        load_level(level)
+    apply_input(frame_input)
+    level_complete = update_game()
+    frame_count += 1
+    return level_complete
+
+
+def next_level():
+    global level
+    level += 1
+    if level <= MAX_LEVELS:
+        load_level(level)
+    else:
+        # The player stays in what is left of the last level, like the original game
+        world.strip()
+        reset_level()
+
+
+def world_checksum():
+    # CRC of the state a replay has to reproduce to stay in sync
+    values = [frame_count, level, player.rect.x, player.rect.y, player.vel_y, player.health, player.ammo, player.grenades]
+    for enemy in enemy_group:
+        values += [enemy.rect.x, enemy.rect.y, enemy.vel_y, enemy.health, enemy.direction]
+    for bullet in bullet_group:
+        values += [bullet.rect.x, bullet.rect.y, bullet.direction]
+    for grenade in grenade_group:
+        values += [grenade.rect.x, grenade.rect.y, grenade.timer]
+    if projectile_system is not None:
+        values += projectile_system.checksum_values()
+    values.append(len(item_box_group))
+    return zlib.crc32(struct.pack(f'<{len(values)}d', *values))
+
+
+def simulation_settings():
+    # The options that change what happens in the game, a recording keeps them so its replay
+    # plays by the same rules
+    return {
+        'enemy_engine': 'sprites' if enemy_engine is None else 'numpy',
+        'ai_budget': None if ai_scheduler is None else ai_scheduler.budget,
+        'enemy_ai': 'navigate' if navigate_enemies else 'patrol',
+        'enemy_vision': 'rect' if line_of_sight is None else 'raycast',
+        'vision_range': 150 if line_of_sight is None else line_of_sight.view_range,
+        'vision_cone': 30.0 if line_of_sight is None else line_of_sight.cone,
+        'projectiles': 'sprites' if projectile_system is None else 'numpy',
+    }
+
+
+def apply_settings(settings):
+    # Switch to the settings of simulation_settings(), raises ValueError for ones that can't be used
+    global enemy_engine, ai_scheduler, navigate_enemies, line_of_sight, projectile_system
+    if np is None and 'numpy' in (settings['enemy_engine'], settings['projectiles']):
+        raise ValueError('--enemy-engine numpy and --projectiles numpy need NumPy installed')
+    numpy_enemies = settings['enemy_engine'] == 'numpy'
+    if settings['ai_budget'] is not None:
+        if not 0 < settings['ai_budget'] < 1 << 32:
+            raise ValueError('--ai-budget must be positive and below 2**32')
+        if numpy_enemies:
+            raise ValueError('--ai-budget only works with --enemy-engine sprites')
+    if settings['enemy_ai'] == 'navigate' and numpy_enemies:
+        raise ValueError('--enemy-ai navigate only works with --enemy-engine sprites')
+    if settings['enemy_vision'] == 'raycast':
+        if numpy_enemies:
+            raise ValueError('--enemy-vision raycast only works with --enemy-engine sprites')
+        if not 0 < settings['vision_range'] < 1 << 32 or not 0 < settings['vision_cone'] <= 90:
+            raise ValueError('--vision-range must be positive and below 2**32, and --vision-cone between 0 and 90')
+    enemy_engine = EnemyEngine() if numpy_enemies else None
+    ai_scheduler = AiScheduler(settings['ai_budget']) if settings['ai_budget'] is not None else None
+    navigate_enemies = settings['enemy_ai'] == 'navigate'
+    line_of_sight = LineOfSight(settings['vision_range'], settings['vision_cone']) if settings['enemy_vision'] == 'raycast' else None
+    projectile_system = ProjectileSystem() if settings['projectiles'] == 'numpy' else None
+
+
+class InputRecorder:
+    # Input bits of every frame plus a world checksum every checksum_interval frames.
+    # Saved as a header, the simulation settings, the inputs run-length encoded as (bits, frames)
+    # pairs, then the checksums.
+    MAGIC = b'BF2R'
+    VERSION = 2
+    HEADER = struct.Struct('<4sBIIHII')  # magic, version, seed, level, checksum interval, runs, checksums
+    # enemy engine, ai budget (0 for none), enemy ai, enemy vision, vision range, vision cone, projectiles
+    SETTINGS = struct.Struct('<BIBBIdB')
+    CHOICES = {'enemy_engine': ('sprites', 'numpy'), 'enemy_ai': ('patrol', 'navigate'),
+               'enemy_vision': ('rect', 'raycast'), 'projectiles': ('sprites', 'numpy')}
+    RUN = struct.Struct('<BH')
+
+    def __init__(self, seed, level, checksum_interval=60, settings=None):
+        self.seed = seed
+        self.level = level
+        self.checksum_interval = checksum_interval
+        self.settings = settings if settings is not None else simulation_settings()
+        self.inputs = bytearray()
+        self.checksums = []
+
+    def record(self, frame_input):
+        # Call after stepping the frame, so the checksum is of the world that input produced
+        self.inputs.append(frame_input)
+        if len(self.inputs) % self.checksum_interval == 0:
+            self.checksums.append(world_checksum())
+
+    def save(self, path):
+        runs = []
+        for frame_input in self.inputs:
+            if runs and runs[-1][0] == frame_input and runs[-1][1] < 0xFFFF:
+                runs[-1][1] += 1
             else:
-                player.update_action(0)  # 0 means first item in self.animation_list[] - means idle image list
-            screen_scroll, level_complete = player.move(moving_left, moving_right)  # screen_scroll - premenantly move the rectangles
-            # print(level_complete)
-            bg_scroll -= screen_scroll  # bg_scroll - reposition the images on screen
-            # print(screen_scroll)
+                runs.append([frame_input, 1])
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.seed, self.level, self.checksum_interval,
+                                     len(runs), len(self.checksums)))
+            settings = self.settings
+            f.write(self.SETTINGS.pack(self.CHOICES['enemy_engine'].index(settings['enemy_engine']), settings['ai_budget'] or 0,
+                                       self.CHOICES['enemy_ai'].index(settings['enemy_ai']),
+                                       self.CHOICES['enemy_vision'].index(settings['enemy_vision']),
+                                       settings['vision_range'], settings['vision_cone'],
+                                       self.CHOICES['projectiles'].index(settings['projectiles'])))
+            for frame_input, frames in runs:
+                f.write(self.RUN.pack(frame_input, frames))
+            f.write(struct.pack(f'<{len(self.checksums)}I', *self.checksums))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, seed, level, checksum_interval, num_of_runs, num_of_checksums = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f'{path} is not a version {cls.VERSION} recording')
+        engine, ai_budget, enemy_ai, enemy_vision, vision_range, vision_cone, projectiles = cls.SETTINGS.unpack_from(data, cls.HEADER.size)
+        settings = {
+            'enemy_engine': cls.CHOICES['enemy_engine'][engine],
+            'ai_budget': ai_budget or None,
+            'enemy_ai': cls.CHOICES['enemy_ai'][enemy_ai],
+            'enemy_vision': cls.CHOICES['enemy_vision'][enemy_vision],
+            'vision_range': vision_range,
+            'vision_cone': vision_cone,
+            'projectiles': cls.CHOICES['projectiles'][projectiles],
+        }
+        recording = cls(seed, level, checksum_interval, settings)
+        offset = cls.HEADER.size + cls.SETTINGS.size
+        for frame_input, frames in cls.RUN.iter_unpack(data[offset:offset + num_of_runs * cls.RUN.size]):
+            recording.inputs += bytes([frame_input]) * frames
+        offset += num_of_runs * cls.RUN.size
+        recording.checksums = list(struct.unpack_from(f'<{num_of_checksums}I', data, offset))
+        return recording
+
+
+def simulate(max_frames=None, controller=None, recorder=None):
+    # Run the game without drawing, sound or frame cap, for max_frames or until the level ends.
+    # controller(frame) returns the input bits to play on that frame, no input if there is none.
+    frame = 0
+    level_complete = False
+    start_time = time.perf_counter()
+    while max_frames is None or frame < max_frames:
+        frame_input = controller(frame) if controller else 0
+        level_complete = step_game(frame_input)
+        if recorder:
+            recorder.record(frame_input)
+        frame += 1
+        if level_complete or not player.alive:
+            break
+    elapsed = time.perf_counter() - start_time
+    return {
+        'level': level,
+        'frames': frame,
+        'level_complete': level_complete,
+        'player_alive': player.alive,
+        'player_health': player.health,
+        'enemies_alive': world.enemies_alive(),
+        'seconds': elapsed,
+        'fps': frame / elapsed if elapsed else 0.0,
+    }
+
+
+def replay(path):
+    # Play a recording back frame for frame as fast as possible, checking every stored checksum.
+    # The game plays by the recording's settings, whatever the command line asked for.
+    global level
+    recording = InputRecorder.load(path)
+    apply_settings(recording.settings)
+    level = recording.level
+    seed_game(recording.seed)
+    load_level(level)
+    first_desync = None
+    start_time = time.perf_counter()
+    for frame, frame_input in enumerate(recording.inputs):
+        level_complete = step_game(frame_input)
+        if (frame + 1) % recording.checksum_interval == 0:
+            if world_checksum() != recording.checksums[frame // recording.checksum_interval] and first_desync is None:
+                first_desync = frame + 1
+        if level_complete:
+            next_level()
+    elapsed = time.perf_counter() - start_time
+    return {
+        'frames': len(recording.inputs),
+        'checksums': len(recording.checksums),
+        'in_sync': first_desync is None,
+        'first_desync_frame': first_desync,
+        'level': level,
+        'settings': recording.settings,
+        'seconds': elapsed,
+        'fps': len(recording.inputs) / elapsed if elapsed else 0.0,
+    }
+
+
+# ------------------------------------------  GAME LOOP  ------------------------------------------
+class Interpolation:
+    # Frames are drawn at their own rate, so a frame usually falls somewhere between two ticks.
+    # The positions from before the last tick are kept, and whatever moved is drawn that part
+    # of the way from there, which keeps motion smooth at any frame rate.
+    def __init__(self):
+        self.world = None
+        self.camera_x = 0
+        self.current_camera_x = 0
+        self.previous = {}
+        self.moved = []
+
+    def moving(self):
+        yield player
+        yield from enemy_group
+        yield from bullet_group
+        yield from grenade_group
+
+    def snapshot(self):
+        # Call before the last tick of a frame
+        self.world = world
+        self.camera_x = camera.x
+        self.previous = {sprite: sprite.rect.topleft for sprite in self.moving()}
+
+    def blend(self, alpha):
+        # Put the camera and everything that moved at the in-between position, restore() undoes it
+        self.moved = []
+        self.current_camera_x = camera.x
+        if self.world is not world:
+            return  # a new level or a restart since the snapshot, nothing to blend with
+        camera.x = round(self.camera_x + (camera.x - self.camera_x) * alpha)
+        for sprite in self.moving():
+            previous = self.previous.get(sprite)
+            x, y = sprite.rect.topleft
+            # Pooled sprites get reused, anything that jumped further than a tile was respawned
+            if previous is None or previous == (x, y) or abs(x - previous[0]) > TILE_SIZE or abs(y - previous[1]) > TILE_SIZE:
+                continue
+            self.moved.append((sprite, x, y))
+            sprite.rect.topleft = (round(previous[0] + (x - previous[0]) * alpha), round(previous[1] + (y - previous[1]) * alpha))
+
+    def restore(self):
+        camera.x = self.current_camera_x
+        for sprite, x, y in self.moved:
+            sprite.rect.topleft = (x, y)
+        self.moved = []
+
+
+interpolation = Interpolation()
+MAX_FRAME_MS = 250  # after a longer stall the game slows down rather than trying to catch up all at once
+
+
+class DirtyRects:
+    # For --dirty-rects: the frame is still drawn in full, but only the parts of the window that
+    # changed get copied to the display, which is what costs the most with software rendering.
+    # A region changed if something moving was drawn there this frame or the last one (to erase it).
+    # Everything gets updated when the camera scrolled, the level changed or a fade is running.
+    MAX_RECTS = 100  # with more than this, one full update is cheaper
+
+    def __init__(self):
+        self.rects = []  # changed this frame, in screen coordinates
+        self.previous = []
+        self.full = True
+        self.world = None
+        self.camera_x = None
+        self.hud_key = None
+        self.hud_area = None
+
+    def invalidate(self):
+        self.full = True
+
+    def add_sprite(self, image, x, y):
+        # x, y is the world position the image was drawn at, 1 pixel either side covers rounding
+        rect = pygame.Rect(x - camera.x - 1, y, image.get_width() + 2, image.get_height())
+        if rect.colliderect(screen_rect):
+            self.rects.append(rect)
+
+    def track_game(self):
+        # Call after draw_game(), while the sprites are still where they were drawn
+        if self.world is not world or self.camera_x != camera.x:
+            self.world = world
+            self.camera_x = camera.x
+            self.invalidate()
+        if self.hud_key != hud.key:
+            self.hud_key = hud.key
+            self.rects += [area for area in (self.hud_area, hud.area) if area]
+            self.hud_area = hud.area
+        for group in (enemy_group, bullet_group, grenade_group, explosion_group, item_box_group):
+            for sprite in group:
+                self.add_sprite(sprite.image, sprite.rect.x, sprite.rect.y)
+        self.add_sprite(player.image, player.rect.x, player.rect.y)
+        if projectile_system is not None:
+            for x, y in zip(projectile_system.bullet_x.tolist(), projectile_system.bullet_y.tolist()):
+                self.add_sprite(bullet_img, x, y)
+            for x, y in zip(projectile_system.grenade_x.tolist(), projectile_system.grenade_y.tolist()):
+                self.add_sprite(grenade_img, x, y)
+
+    def update(self):
+        if profiler.enabled and profiler.drawn_rect:
+            self.rects.append(profiler.drawn_rect)
+        rects = self.previous + self.rects
+        if self.full or len(rects) > self.MAX_RECTS:
+            pygame.display.update()
+        elif rects:
+            pygame.display.update(rects)
+        self.previous = self.rects
+        self.rects = []
+        self.full = False
+
+
+screen_rect = screen.get_rect()
+
+
+def main(seed=None, record_path=None, checksum_interval=60, profile_path=None, render_fps=FPS, time_scale=1.0):
+    # The simulation always ticks FPS times per second of game time, independent of how many
+    # frames get drawn (render_fps). time_scale runs game time slower or faster than real time.
+    global run, start_game, start_intro
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    seed_game(seed)
+    load_level(level)
+    recorder = InputRecorder(seed, level, checksum_interval) if record_path else None
+    if profile_path:
+        profiler.export(profile_path)
+    held_input = 0
+    edge_input = 0  # jumps and restarts wait here until a tick uses them
+    accumulator = 0  # game time owed to the simulation, in milliseconds times FPS (1000 is one tick)
+    run = True
+    while run:
+
+        elapsed = min(clock.tick(render_fps), MAX_FRAME_MS)
+        profiler.start_frame()
+
+        restart = False
+        if start_game == False:
+            edge_input = 0  # keys pressed on the menu don't carry over into the game
+            # Main Menu
+            screen.fill(BG)
+            # Add buttons
+            if start_button.draw(screen):
+                start_game = True
+                start_intro = True
+            if exit_button.draw(screen):
+                run = False
+            
+        else:
+            # Run as many fixed ticks as the time since the last frame pays for
+            accumulator += elapsed * time_scale * FPS
+            level_complete = False
+            while accumulator >= 1000:
+                accumulator -= 1000
+                if accumulator < 1000:
+                    interpolation.snapshot()
+                frame_input = held_input | edge_input
+                edge_input = 0
+                level_complete = step_game(frame_input)
+                if recorder:
+                    recorder.record(frame_input)
+                if level_complete:
+                    accumulator = 0
+                    break
+
+            # Draw the world in between the last two ticks
+            interpolation.blend(accumulator / 1000)
+            draw_game()
+            if dirty_rects is not None:
+                dirty_rects.track_game()
+            interpolation.restore()
+
+            # Fades change the whole screen, the death fade is done once the restart button shows
+            if dirty_rects is not None and (start_intro or not player.alive and death_fade.fade_counter <= SCREEN_WIDTH):
+                dirty_rects.invalidate()
+
+            # Show intro
+            if start_intro == True:
+                if intro_fade.fade():
+                    start_intro = False
+                    intro_fade.fade_counter = 0
 
             # Check if the player has completed the level
             if level_complete:
                 start_intro = True
-                level += 1
-                bg_scroll = 0
-                world_data = reset_level()
-                if level <= MAX_LEVELS:
-                    with open(f'level{level}_data.csv', newline='') as csvfile:
-                        reader = csv.reader(csvfile, delimiter=',')
-                        for x, row in enumerate(reader):
-                            # x is the row index
-                            for y, tile in enumerate(row):
-                                # y is the column index
-                                world_data[x][y] = int(tile)  # as the value returned from csv file will be string
-                    world = World()
-                    player, health_bar = world.process_data(world_data)
-        else:
-            screen_scroll = 0
-            if death_fade.fade():
-                if restart_button.draw(screen):
-                    death_fade.fade_counter = 0
-                    start_intro = True
-                    bg_scroll = 0
-                    world_data = reset_level()
-                    with open(f'level{level}_data.csv', newline='') as csvfile:
-                        reader = csv.reader(csvfile, delimiter=',')
-                        for x, row in enumerate(reader):
-                            # x is the row index
-                            for y, tile in enumerate(row):
-                                # y is the column index
-                                world_data[x][y] = int(tile)  # as the value returned from csv file will be string
-                    world = World()
-                    player, health_bar = world.process_data(world_data)
-
-                
-
-
-
-    # Event handler
-    for event in pygame.event.get():
-        # QUIT GAME
-        if event.type == pygame.QUIT:
-            # User clicked the x button the right
-            run = False
-
-        # Keyboard Presses
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_a:
-                moving_left = True
-            if event.key == pygame.K_d:
-                moving_right = True
-            if event.key == pygame.K_w and player.alive:
-                player.jump = True
-                jump_fx.play()
-            if event.key == pygame.K_SPACE:
-                shoot = True
-            if event.key == pygame.K_q:
-                grenade = True
-
-            if event.key == pygame.K_ESCAPE:
+                next_level()
+            elif not player.alive:
+                if death_fade.fade():
+                    if restart_button.draw(screen):
+                        death_fade.fade_counter = 0
+                        start_intro = True
+                        restart = True  # the level gets reloaded at the start of the next frame
+            profiler.mark('fades')
+
+        # Event handler
+        if restart:
+            edge_input |= INPUT_RESTART
+        for event in pygame.event.get():
+            # QUIT GAME
+            if event.type == pygame.QUIT:
+                # User clicked the x button the right
                 run = False
 
-        # Keyboard button releases
-        if event.type == pygame.KEYUP:
-            if event.key == pygame.K_a:
-                moving_left = False
-            if event.key == pygame.K_d:
-                moving_right = False
-            if event.key == pygame.K_SPACE:
-                shoot = False
-            if event.key == pygame.K_q:
-                grenade = False
-                grenade_thrown = False
-
-    pygame.display.update()
-
-pygame.quit()
+            # Keyboard Presses
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_a:
+                    held_input |= INPUT_LEFT
+                if event.key == pygame.K_d:
+                    held_input |= INPUT_RIGHT
+                if event.key == pygame.K_w:
+                    edge_input |= INPUT_JUMP
+                if event.key == pygame.K_SPACE:
+                    held_input |= INPUT_SHOOT
+                if event.key == pygame.K_q:
+                    held_input |= INPUT_GRENADE
+
+                if event.key == pygame.K_F3:
+                    profiler.toggle()
+
+                if event.key == pygame.K_ESCAPE:
+                    run = False
+
+            # Keyboard button releases
+            if event.type == pygame.KEYUP:
+                if event.key == pygame.K_a:
+                    held_input &= ~INPUT_LEFT
+                if event.key == pygame.K_d:
+                    held_input &= ~INPUT_RIGHT
+                if event.key == pygame.K_SPACE:
+                    held_input &= ~INPUT_SHOOT
+                if event.key == pygame.K_q:
+                    held_input &= ~INPUT_GRENADE
+        profiler.mark('events')
+
+        profiler.draw(screen)
+        if dirty_rects is not None:
+            dirty_rects.update()
+        else:
+            pygame.display.update()
+        profiler.mark('display update')
+        profiler.end_frame()
+
+    if recorder:
+        recorder.save(record_path)
+    profiler.close()
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Battle Field 2D')
+    parser.add_argument('--headless', action='store_true', help='run the simulation without a display, as fast as possible')
+    parser.add_argument('--level', type=int, default=level, help='level to play')
+    parser.add_argument('--frames', type=int, default=FPS * 60 * 5, help='headless: stop after this many frames (default: 5 minutes of play)')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the game\'s random numbers (default: random)')
+    parser.add_argument('--record', metavar='FILE', help='record the input of this run to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='play back a recording in fast-forward and check it stays in sync')
+    parser.add_argument('--checksum-interval', type=int, default=60, help='frames between world checksums in a recording')
+    parser.add_argument('--profile-out', metavar='FILE', help='write per-frame stage timings to FILE (.csv, or .json for JSON lines)')
+    parser.add_argument('--enemy-engine', choices=['sprites', 'numpy'], default='sprites',
+                        help='update the enemies one sprite at a time, or all at once with NumPy, which pays off with hundreds of enemies (kept in recordings)')
+    parser.add_argument('--ai-budget', type=int, metavar='N',
+                        help='let at most N enemies think per frame, nearest to the screen first, the rest take turns (kept in recordings)')
+    parser.add_argument('--enemy-ai', choices=['patrol', 'navigate'], default='patrol',
+                        help='let the enemies patrol blindly, or patrol, chase and find a way to the player with a navigation graph of the level (kept in recordings)')
+    parser.add_argument('--enemy-vision', choices=['rect', 'raycast'], default='rect',
+                        help='enemies see the player in a rect in front of them, even through walls, or only along a clear line of sight (kept in recordings)')
+    parser.add_argument('--vision-range', type=int, default=150, help='raycast vision: how many pixels far the enemies see')
+    parser.add_argument('--vision-cone', type=float, default=30, help='raycast vision: how many degrees above or below straight ahead the enemies see')
+    parser.add_argument('--projectiles', choices=['sprites', 'numpy'], default='sprites',
+                        help='update bullets and grenades one sprite at a time, or in batches with NumPy (kept in recordings)')
+    parser.add_argument('--render-fps', type=int, default=FPS, help=f'frames drawn per second, the game itself always runs at {FPS} ticks a second')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='game seconds per real second, e.g. 0.5 for slow motion or 4 to fast-forward')
+    parser.add_argument('--dirty-rects', action='store_true', help='only update the parts of the window that changed, for software rendering on slow machines')
+    args = parser.parse_args()
+    level = args.level
+    if args.seed is not None and not 0 <= args.seed < 1 << 32:
+        parser.error('--seed must be between 0 and 2**32 - 1')
+    try:
+        apply_settings({'enemy_engine': args.enemy_engine, 'ai_budget': args.ai_budget, 'enemy_ai': args.enemy_ai,
+                        'enemy_vision': args.enemy_vision, 'vision_range': args.vision_range, 'vision_cone': args.vision_cone,
+                        'projectiles': args.projectiles})
+    except ValueError as error:
+        parser.error(str(error))
+    if args.render_fps <= 0 or args.time_scale <= 0:
+        parser.error('--render-fps and --time-scale must be positive')
+    if args.dirty_rects:
+        dirty_rects = DirtyRects()
+    if args.replay:
+        try:
+            result = replay(args.replay)
+        except ValueError as error:
+            parser.error(str(error))
+        print(json.dumps(result))
+        pygame.quit()
+    elif HEADLESS:
+        seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+        seed_game(seed)
+        load_level(level)
+        recorder = InputRecorder(seed, level, args.checksum_interval) if args.record else None
+        result = simulate(args.frames, recorder=recorder)
+        if recorder:
+            recorder.save(args.record)
+        print(json.dumps(dict(result, seed=seed)))
+        pygame.quit()
+    else:
+        main(args.seed, args.record, args.checksum_interval, args.profile_out, args.render_fps, args.time_scale)
 
 
 
@@ -0,0 +1,94 @@
+"""
+Compact binary level format, shared by the game and the level editor.
+
+A level file is a 12 byte header followed by the tile matrix, one signed byte per tile, row by row:
+
+    magic    4 bytes   b'BFLV'
+    version  uint16    1
+    rows     uint16
+    cols     uint32
+
+Loading maps the file into memory and hands out memoryview rows over it, so no tile is parsed
+one by one in Python. The CSV files stay the readable copy of each level. A binary file older than
+its CSV is out of date, the game converts it again before loading it. Convert between the two with
+
+    python level_format.py level1_data.csv level1_data.bfl
+    python level_format.py level1_data.bfl level1_data.csv
+"""
+import csv
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = b'BFLV'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')  # magic, version, rows, cols
+
+
+def load(path):
+    # Returns the level as a list of rows, each a read-only memoryview of ints over the mapped file
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < HEADER.size:
+        raise ValueError(f'{path} is not a version {VERSION} level file')
+    magic, version, rows, cols = HEADER.unpack_from(mapped)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} level file')
+    if len(mapped) != HEADER.size + rows * cols:
+        raise ValueError(f'{path} should be {HEADER.size + rows * cols} bytes for {rows}x{cols} tiles, not {len(mapped)}')
+    tiles = memoryview(mapped)[HEADER.size:HEADER.size + rows * cols].cast('b')
+    return [tiles[row * cols:(row + 1) * cols] for row in range(rows)]
+
+
+def save(path, data):
+    # Written to a new file next to it and then swapped in, never over the old file in place, so a
+    # game that has the old file memory-mapped keeps its old tiles instead of crashing
+    rows = len(data)
+    cols = len(data[0])
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, rows, cols))
+            for row in data:
+                f.write(struct.pack(f'{cols}b', *row))
+        # mkstemp makes the file private, keep the permissions the level file had
+        os.chmod(temp_path, os.stat(path).st_mode if os.path.exists(path) else 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def is_stale(path, source):
+    # True when the binary file at path is older than the CSV source it is a copy of, i.e. the
+    # CSV was edited since, and has to be converted again
+    return os.path.exists(source) and os.stat(source).st_mtime_ns > os.stat(path).st_mtime_ns
+
+
+def load_csv(path):
+    with open(path, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        return [[int(tile) for tile in row] for row in reader]
+
+
+def save_csv(path, data):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        for row in data:
+            writer.writerow(list(row))
+
+
+def convert(src, dst):
+    data = load_csv(src) if src.endswith('.csv') else load(src)
+    if dst.endswith('.csv'):
+        save_csv(dst, data)
+    else:
+        save(dst, data)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python level_format.py SOURCE DESTINATION  (.csv <-> .bfl)')
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,247 @@
+"""
+Playtest farm for balancing the levels.
+
+Plays every level with many seeds at once, one headless game per CPU core, with a bot at the
+controls instead of a person, and sums up how the runs went per level as JSON: how often the exit
+was reached and how fast, what the player died of, which item boxes got picked up and how many
+frames a second the simulation ran at.
+
+    python playtest.py --runs 100
+    python playtest.py --levels 1 2 --runs 500 --bot scripted --output playtest.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ['BATTLEFIELD_HEADLESS'] = '1'
+import pygame
+import game
+
+DEATH_CAUSES = ['bullet', 'grenade', 'water', 'fall']
+
+
+# ------------------------------------------  BOTS  ------------------------------------------
+class ScriptedBot:
+    # Keeps running right, jumps every so often and shoots now and then, like benchmark.walk_right,
+    # but with its own rhythm for every seed
+    def __init__(self, rng):
+        self.jump_every = rng.randint(30, 60)
+        self.shoot_every = rng.randint(20, 40)
+
+    def __call__(self, frame):
+        frame_input = game.INPUT_RIGHT
+        if frame % self.jump_every == 0:
+            frame_input |= game.INPUT_JUMP
+        if frame % self.shoot_every < 5:
+            frame_input |= game.INPUT_SHOOT
+        return frame_input
+
+
+class HeuristicBot:
+    # Heads for the exit on the right. It looks a jump's length ahead for gaps and water and runs on
+    # to jump them from the edge, jumps walls in the way, stops to shoot enemies in front of it unless
+    # it is about to jump, throws a grenade at groups or at enemies on another level, and backs off
+    # for a moment when it stays stuck. The rng makes it hesitate differently for every seed.
+    SIGHT = 350  # pixels ahead it reacts to enemies
+    GRENADE_RANGE = 250
+    JUMP_FRAMES = 29  # frames a jump (vel_y -11, GRAVITY 0.75) stays above where it started, times the speed is how far it goes
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.last_x = None
+        self.stuck = 0
+        self.retreat = 0
+        self.charge = 0  # frames it keeps running past enemies instead of stopping to shoot
+
+    def blocked(self, rect):
+        return any(tile[1].colliderect(rect) for tile in game.world.query('obstacle', rect))
+
+    def unsafe(self, x, bottom):
+        # Nothing to stand on at x within two tiles under bottom, or water there
+        probe = pygame.Rect(x, bottom - 1, 1, game.TILE_SIZE * 2)
+        return not self.blocked(probe) or any(sprite.rect.colliderect(probe) for sprite in game.world.query('water', probe))
+
+    def hazard(self, player, direction):
+        # How far ahead of its front the first gap or water is, None if there is none within a jump
+        front = player.rect.right if direction == 1 else player.rect.left - 1
+        for distance in range(0, self.JUMP_FRAMES * player.speed, player.speed):
+            if self.unsafe(front + direction * distance, player.rect.bottom):
+                return distance
+        return None
+
+    def __call__(self, frame):
+        player = game.player
+        tile = game.TILE_SIZE
+        if self.last_x == player.rect.x:
+            self.stuck += 1
+        else:
+            self.stuck = 0
+        self.last_x = player.rect.x
+        if self.stuck > 45:
+            self.stuck = 0
+            self.retreat = self.rng.randint(10, 40)
+
+        direction = 1
+        if self.retreat:
+            self.retreat -= 1
+            direction = -1
+        frame_input = game.INPUT_RIGHT if direction == 1 else game.INPUT_LEFT
+        hazard = None if player.in_air else self.hazard(player, direction)
+
+        # Enemies in front of it, nearest first
+        ahead = []
+        for enemy in game.enemy_group:
+            distance = (enemy.rect.centerx - player.rect.centerx) * direction
+            if enemy.alive and 0 < distance < self.SIGHT:
+                ahead.append((distance, enemy))
+        ahead.sort(key=lambda item: item[0])
+        if ahead:
+            distance, enemy = ahead[0]
+            same_level = abs(enemy.rect.centery - player.rect.centery) < tile
+            if same_level and player.ammo > 0:
+                frame_input |= game.INPUT_SHOOT
+                if self.charge:
+                    self.charge -= 1
+                elif self.rng.random() < 0.02:
+                    self.charge = self.rng.randint(10, 30)
+                elif player.direction == direction and not player.in_air and hazard is None:
+                    frame_input &= ~(game.INPUT_LEFT | game.INPUT_RIGHT)  # stand and shoot
+                    self.stuck = 0
+            near = [enemy for distance, enemy in ahead if distance < self.GRENADE_RANGE]
+            if player.grenades > 0 and frame % 30 == 0 and (len(near) >= 2 or near and not same_level):
+                frame_input |= game.INPUT_GRENADE
+
+        # Jump walls in the way, and gaps and water from the very edge, still running so it gets furthest.
+        # Coming down towards a gap it stops going forward, to land before the edge and jump from there.
+        if player.in_air:
+            edge = player.rect.right + 2 if direction == 1 else player.rect.left - 2
+            if player.vel_y > 0 and self.unsafe(edge, player.rect.bottom) and not self.unsafe(player.rect.centerx, player.rect.bottom):
+                frame_input &= ~(game.INPUT_LEFT | game.INPUT_RIGHT)
+        elif self.blocked(player.rect.move(direction * tile // 2, 0)) or hazard is not None and hazard < player.speed:
+            frame_input |= game.INPUT_JUMP
+        return frame_input
+
+
+BOTS = {'heuristic': HeuristicBot, 'scripted': ScriptedBot}
+
+
+# ------------------------------------------  RUNS  ------------------------------------------
+def play(level, seed, bot, max_frames):
+    # One run of one level, in whichever worker process picked it up
+    game.level = level
+    game.seed_game(seed)
+    game.load_level(level)
+    controller = BOTS[bot](random.Random(seed))
+    frame = 0
+    level_complete = False
+    furthest = game.player.rect.right
+    start_time = time.perf_counter()
+    while frame < max_frames:
+        level_complete = game.step_game(controller(frame))
+        frame += 1
+        furthest = max(furthest, game.player.rect.right)
+        if level_complete or not game.player.alive:
+            break
+    elapsed = time.perf_counter() - start_time
+    return {
+        'level': level,
+        'seed': seed,
+        'frames': frame,
+        'level_complete': level_complete,
+        'death_cause': None if game.player.alive else game.player.last_damage,
+        'progress': min(furthest / (game.world.level_length * game.TILE_SIZE), 1.0),  # how far right it got
+        'player_health': game.player.health,
+        'pickups': dict(game.player.pickups),
+        'enemies_alive': game.world.enemies_alive(),
+        'seconds': elapsed,
+    }
+
+
+def summarize(runs):
+    completed = [run for run in runs if run['level_complete']]
+    deaths = dict.fromkeys(DEATH_CAUSES, 0)
+    for run in runs:
+        if run['death_cause'] is not None:
+            deaths[run['death_cause']] = deaths.get(run['death_cause'], 0) + 1
+    exit_seconds = [run['frames'] / game.FPS for run in completed]
+    frames = sum(run['frames'] for run in runs)
+    seconds = sum(run['seconds'] for run in runs)
+    return {
+        'runs': len(runs),
+        'completion_rate': len(completed) / len(runs) if runs else 0.0,
+        'mean_progress': statistics.mean(run['progress'] for run in runs) if runs else 0.0,
+        'time_to_exit_s': {
+            'mean': statistics.mean(exit_seconds) if exit_seconds else None,
+            'median': statistics.median(exit_seconds) if exit_seconds else None,
+            'min': min(exit_seconds, default=None),
+            'max': max(exit_seconds, default=None),
+        },
+        'deaths': deaths,
+        'timeouts': sum(1 for run in runs if run['death_cause'] is None and not run['level_complete']),
+        'pickups_per_run': {item: sum(run['pickups'][item] for run in runs) / len(runs) if runs else 0.0
+                            for item in game.item_boxes},
+        'simulated_fps': frames / seconds if seconds else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play the levels with a bot over many seeds in parallel and report how the runs went.')
+    parser.add_argument('--levels', type=int, nargs='+', default=list(range(1, game.MAX_LEVELS + 1)), help='levels to play (default: all)')
+    parser.add_argument('--runs', type=int, default=50, help='runs per level, each with its own seed')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first run, the others count up from it')
+    parser.add_argument('--bot', choices=list(BOTS), default='heuristic', help='who plays')
+    parser.add_argument('--max-frames', type=int, default=game.FPS * 60 * 3, help='give up on a run after this many frames (default: 3 minutes of play)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes to run games in (default: one per core)')
+    parser.add_argument('--output', metavar='FILE', help='write the results, including every run, to FILE instead of printing the summary')
+    args = parser.parse_args()
+    if args.runs <= 0 or args.workers <= 0 or args.max_frames <= 0:
+        parser.error('--runs, --workers and --max-frames must be positive')
+    for level in args.levels:
+        if not 1 <= level <= game.MAX_LEVELS:
+            parser.error(f'there is no level {level}')
+
+    tasks = [(level, args.seed + i, args.bot, args.max_frames) for level in args.levels for i in range(args.runs)]
+    runs = []
+    start_time = time.perf_counter()
+    # Every worker starts its own copy of the game instead of inheriting this process's pygame
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(play, *task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), 1):
+            runs.append(future.result())
+            if done % 50 == 0 or done == len(futures):
+                print(f'{done}/{len(futures)} runs', file=sys.stderr)
+    elapsed = time.perf_counter() - start_time
+    runs.sort(key=lambda run: (run['level'], run['seed']))
+
+    results = {
+        'meta': {
+            'bot': args.bot,
+            'runs_per_level': args.runs,
+            'first_seed': args.seed,
+            'max_frames': args.max_frames,
+            'workers': args.workers,
+            'seconds': elapsed,
+            'frames_per_second': sum(run['frames'] for run in runs) / elapsed if elapsed else 0.0,
+        },
+        'levels': {level: summarize([run for run in runs if run['level'] == level]) for level in args.levels},
+    }
+    for level, stats in results['levels'].items():
+        print(f'level {level}: {stats["completion_rate"]:.0%} complete, {stats["mean_progress"]:.0%} of the way on average, deaths {stats["deaths"]}, '
+              f'timeouts {stats["timeouts"]}', file=sys.stderr)
+    if args.output:
+        results['runs'] = runs
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+
+os.environ['BATTLEFIELD_HEADLESS'] = '1'
+import pytest
+import game
+
+pytestmark = pytest.mark.skipif(game.np is None, reason='the enemy engine needs NumPy')
+
+
+@pytest.fixture
+def engine():
+    game.enemy_engine = game.EnemyEngine()
+    game.level = 1
+    game.seed_game(1)
+    game.load_level(1)
+    game.step_game(0)
+    yield game.enemy_engine
+    game.enemy_engine = None
+
+
+def test_load_keeps_damage_taken_since_the_last_update(engine):
+    enemies = game.enemy_group.sprites()
+    enemies[0].hurt(50, 'bullet')
+    # The enemies change, e.g. when a chunk is paged in or out
+    engine.load(enemies[1:])
+    assert enemies[0].health == 50
+    engine.load(enemies)
+    game.step_game(0)
+    assert enemies[0].health == 50
+
+
+class NeverIdle:
+    # Stands in for the engine's random generator, no roll ever makes an enemy stop
+    def integers(self, low, high, size):
+        return game.np.full(size, high - 1)
+
+
+def play_level_1(frames):
+    # Enemy positions, health and ammo after every frame of running right, jumping and shooting
+    game.level = 1
+    game.seed_game(1)
+    game.load_level(1)
+    states = []
+    for frame in range(frames):
+        jump = game.INPUT_JUMP if frame % 30 == 0 else 0
+        shoot = game.INPUT_SHOOT if frame % 20 < 5 else 0
+        game.step_game(game.INPUT_RIGHT | jump | shoot)
+        states.append(sorted((enemy.spawn_cell, enemy.rect.topleft, enemy.health, enemy.ammo) for enemy in game.enemy_group))
+    return states
+
+
+def test_engine_plays_like_the_sprites(monkeypatch):
+    # Idling is rolled with different random generators, with it out of the way both have to match
+    monkeypatch.setattr(game.rng, 'randint', lambda low, high: high)
+    monkeypatch.setattr(game.np.random, 'default_rng', lambda seed: NeverIdle())
+    sprites = play_level_1(300)
+    game.enemy_engine = game.EnemyEngine()
+    try:
+        engine = play_level_1(300)
+    finally:
+        game.enemy_engine = None
+    assert any(enemy[3] < 20 for enemy in sprites[-1])  # the enemies did shoot
+    assert any(enemy[2] < 100 for enemy in sprites[-1])  # and got shot
+    for frame, (expected, actual) in enumerate(zip(sprites, engine)):
+        assert actual == expected, f'frame {frame}'
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import level_format
+
+LEVEL = [[-1, 0, 1, 20], [9, 10, 15, 16], [0, 0, 0, 0]]
+
+
+def test_save_and_load_give_back_the_level(tmp_path):
+    path = str(tmp_path / 'level.bfl')
+    level_format.save(path, LEVEL)
+    assert [row.tolist() for row in level_format.load(path)] == LEVEL
+
+
+def test_load_rejects_a_truncated_file(tmp_path):
+    path = tmp_path / 'level.bfl'
+    level_format.save(str(path), LEVEL)
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        level_format.load(str(path))
+
+
+def test_load_rejects_a_file_shorter_than_the_header(tmp_path):
+    path = tmp_path / 'level.bfl'
+    path.write_bytes(level_format.MAGIC)
+    with pytest.raises(ValueError):
+        level_format.load(str(path))
+
+
+def test_load_rejects_the_wrong_magic(tmp_path):
+    path = tmp_path / 'level.bfl'
+    path.write_bytes(level_format.HEADER.pack(b'CSV,', level_format.VERSION, 1, 1) + b'\0')
+    with pytest.raises(ValueError):
+        level_format.load(str(path))
+
+
+def test_load_rejects_another_version(tmp_path):
+    path = tmp_path / 'level.bfl'
+    path.write_bytes(level_format.HEADER.pack(level_format.MAGIC, level_format.VERSION + 1, 1, 1) + b'\0')
+    with pytest.raises(ValueError):
+        level_format.load(str(path))
+
+
+def test_a_binary_file_older_than_its_csv_is_stale(tmp_path):
+    path, source = str(tmp_path / 'level.bfl'), str(tmp_path / 'level.csv')
+    level_format.save_csv(source, LEVEL)
+    level_format.convert(source, path)
+    assert not level_format.is_stale(path, source)
+    os.utime(source, ns=(os.stat(path).st_mtime_ns + 10**9,) * 2)
+    assert level_format.is_stale(path, source)
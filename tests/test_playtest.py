@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+import playtest
+import game
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_heuristic_bot_gets_past_the_first_water_of_level_1(seed):
+    data = game.read_level(1)
+    wet = [col for col in range(len(data[0])) if any(row[col] in (9, 10) for row in data)]
+    first_pool_end = next(col for col in wet if col + 1 not in wet) + 1
+    game.level = 1
+    game.seed_game(seed)
+    game.load_level(1)
+    bot = playtest.HeuristicBot(random.Random(seed))
+    furthest = game.player.rect.left
+    for frame in range(game.FPS * 20):
+        game.step_game(bot(frame))
+        furthest = max(furthest, game.player.rect.left)
+        if not game.player.alive:
+            break
+    assert furthest >= first_pool_end * game.TILE_SIZE
+    assert game.player.alive or game.player.last_damage != 'water'